@@ -1,9 +1,15 @@
 import sys
 sys.path.append('../')
 
+import article_store
 import datetime
+import candidates
 import database
+import dna_vectors
+import engagement_ring
 import logging
+import memo
+import numpy as np
 import pymongo
 import json
 import random
@@ -28,12 +34,36 @@ except Exception as e:
     
 db = mongo_client.noozli
 collection = db.streaming
+bodies = db.bodies
 
 try:
     cassandra_client = database.NoozliClient()
     cassandra_client.connect(['127.0.0.1'])
 except Exception as e:
     log.warning('Failed to connect to cassandra.')
+
+candidate_index = candidates.CandidateIndex(collection, bodies, engagement=cassandra_client.get_article_engagement)
+
+# dna matrix written by the ingester, mapped read only and shared by every api process
+shared_articles = article_store.ArticleStore()
+
+# ((store generation, candidate index version), candidates missing from the store), see missing_from_store
+store_missing = (None, [])
+
+# windows with more candidates than this are ranked with the topic postings instead of scoring every article
+topk_min_candidates = 500
+
+# articles served when a request leaves out count: WeightedAverage picks at most one
+# article per ranking (overall + five buckets) in each window
+max_count = 6 * len(candidates.time_deltas)
+
+ranking_memo = memo.RankingMemo()
+
+# length of the shared rankings kept for look-alike users, the most WeightedAverage ranks
+memo_depth = max_count
+
+# seconds a shared ranking is used, the window bounds and recency weights move with the clock
+memo_seconds = 60
     
 
 """
@@ -42,8 +72,9 @@ use wrapper function
 """
 def learn(user_id, analytics, algo):
 
-    if algo == 1:
-        user = NoozliBasic(user_id)
+    if algo in [1, 2, 3]:
+        # every serve algorithm learns with the weighted average dna update
+        user = WeightedAverage(user_id)
         user.learn(analytics)
 
     else:
@@ -67,52 +98,10 @@ class NoozliAlgo:
     def serve(self, count):
         raise NotImplementedError("serve method not implemented")
 
-# textrazor
-topic_to_index = {
-    'Arts': 0,
-    'Belief': 1,
-    'Business': 2,
-    'Culture': 3,
-    'Education': 4,
-    'Environment': 5,
-    'Health': 6,
-    'History': 7,     
-    'Language': 8,
-    'Law': 9,
-    'Leisure': 10,
-    'Mathematics': 11,
-    'Nature': 12,
-    'People': 13,
-    'Politics': 14,
-    'Science': 15,
-    'Sports': 16,
-    'Technology': 17,
-    'Violence': 18,
-    'Weather': 19
-    }
-
-index_to_topic = [
-    'Arts',
-    'Belief',
-    'Business',
-    'Culture',
-    'Education',
-    'Environment',
-    'Health',
-    'History',     
-    'Language',
-    'Law',
-    'Leisure',
-    'Mathematics',
-    'Nature',
-    'People',
-    'Politics',
-    'Science',
-    'Sports',
-    'Technology',
-    'Violence',
-    'Weather'
-]
+# textrazor, the dna dimensions are defined with the article dna in dna_vectors
+topic_to_index = dna_vectors.topic_to_index
+
+index_to_topic = sorted(topic_to_index, key=topic_to_index.get)
 
 topic_to_bucket = {
     'Arts': ['Arts', 'Culture', 'Leisure'],
@@ -156,6 +145,121 @@ def inner_product(a, b):
     except:
         return 0
 
+def bucket_masks(user_dna):
+    """
+    Build the category masks for the overall ranking and the five top bucket rankings
+
+    :param user_dna: list of floats, user dna
+    :returns: numpy array 6 x 20, row 0 keeps every category, row i zeroes the categories of the i-th top bucket
+    """
+
+    masks = np.ones((6, len(user_dna)))
+    user_dna_copy = list(user_dna)
+    for i in range(1, 6):
+        bucket = topic_to_bucket[index_to_topic[user_dna_copy.index(max(user_dna_copy))]]
+        for category in bucket:
+            user_dna_copy[topic_to_index[category]] = 0
+            masks[i, topic_to_index[category]] = 0
+    return masks
+
+def article_dna_matrix(dnas):
+    """
+    Stack the dna of candidate articles into one matrix
+
+    :param dnas: list of article dna vectors, e.g. Candidate.dna or dna_vectors.article_dna
+    :returns: numpy array len(dnas) x 20
+    """
+
+    return np.array(dnas).reshape(len(dnas), dna_vectors.dna_length)
+
+def score_articles(article_matrix, user_dna, masks):
+    """
+    Score all candidates for all six rankings with a single matrix product
+
+    :param article_matrix: numpy array n x 20 of article dna
+    :param user_dna: list of floats, user dna
+    :param masks: numpy array 6 x 20 from bucket_masks
+    :returns: numpy array n x 6, column 0 is the overall score, columns 1-5 the bucket zeroed scores
+    """
+
+    return np.dot(article_matrix, (masks * np.asarray(user_dna, dtype=float)).T)
+
+def candidate_columns(start, end):
+    """
+    Candidates with start <= timestamp < end as columns, oldest first.  Read straight from
+    the shared article store when the ingester maintains one, built from the candidate
+    index otherwise.
+
+    :param start: datetime, start of the window (inclusive)
+    :param end: datetime, end of the window (exclusive)
+    :returns: (list of article ids, numpy array of epoch timestamps, numpy array n x 20 of article dna)
+    """
+
+    columns = shared_articles.window(start, end)
+    if columns is None:
+        return index_columns(candidate_index.window(start, end))
+
+    # articles the ingester has not appended yet, or failed to append, come from the index
+    missing = [ art for art in missing_from_store() if start <= art.timestamp < end ]
+    if len(missing) == 0:
+        return columns
+
+    article_ids, timestamps, matrix = columns
+    missing_ids, missing_timestamps, missing_matrix = index_columns(missing)
+
+    timestamps = np.concatenate([timestamps, missing_timestamps])
+    order = np.argsort(timestamps, kind='mergesort')
+    article_ids = article_ids + missing_ids
+    return [ article_ids[row] for row in order ], timestamps[order], np.vstack([matrix, missing_matrix])[order]
+
+def index_columns(articles):
+    """
+    :param articles: list of Candidates, oldest first
+    :returns: (list of article ids, numpy array of epoch timestamps, numpy array n x 20 of article dna)
+    """
+
+    timestamps = np.array([ article_store.to_epoch(art.timestamp) for art in articles ])
+    return [ art.article_id for art in articles ], timestamps, article_dna_matrix([ art.dna for art in articles ])
+
+def missing_from_store():
+    """
+    Candidate index articles the mapped generation of the article store does not hold,
+    found again whenever either of them changes
+
+    :returns: list of Candidates, oldest first
+    """
+
+    global store_missing
+
+    generation, article_ids = shared_articles.mapped[:2]
+    key = (generation, candidate_index.version)
+    if store_missing[0] != key:
+        stored = set(article_ids)
+        store_missing = (key, [ art for art in candidate_index.window(datetime.datetime.min, datetime.datetime.max) if art.article_id not in stored ])
+
+    return store_missing[1]
+
+def popularity(article_ids):
+    """
+    :param article_ids: list of candidate article ids
+    :returns: numpy array of the popularity of each article, 0.5 for articles not loaded in the candidate index
+    """
+
+    popularities = np.empty(len(article_ids))
+    for row, article_id in enumerate(article_ids):
+        art = candidate_index.get(article_id)
+        popularities[row] = art.popularity() if art is not None else 0.5
+    return popularities
+
+def servable(article_ids, served):
+    """
+    :param article_ids: list of candidate article ids
+    :param served: set of article ids already served
+    :returns: numpy bool array, True for articles not served yet that are loaded in the candidate index
+    """
+
+    return np.array([ article_id not in served and article_id in candidate_index for article_id in article_ids ], dtype=bool)
+
 """
 #
 # Engagement mapping
@@ -240,154 +344,411 @@ class WeightedAverage(NoozliAlgo):
 
         
     def learn(self, analytics):
+        """
+        Update the user dna with the analytics of a post.  Articles are read with one query,
+        the recent engagements come with the user row and the updated dna is written back once.
+
+        :param analytics: list of dicts, analytics of each article with its 'article_id'
+        """
 
         start = time.time()
     
         user_data = cassandra_client.find_user(self.user_id)
+        user_dna = database.user_dna(user_data)
+
+        article_ids = [ data['article_id'] for data in analytics ]
+        articles = {}
+        for article in collection.find({'article_id': {'$in': article_ids}}, {'article_id': True, 'dna': True, 'topics': True}):
+            articles[article['article_id']] = article
 
         log.info(self.user_id)
         for data in analytics:
 
-            coeff = engagement_mapping(data, user_data.engagement_mapping)
-            log.info('mapping coeff:  ' + str(coeff))
-            article = collection.find_one({'article_id': data['article_id']})
-            article_dna = article_to_dna_mapping(article['topics']['text_razor'])
-            log.info('article_dna:  ' + str(article_dna))
-
-            user_dna = json.loads(user_data.dna)['dna']
-            log.info('user_dna:  ' + str(user_dna))
-            updated_dna = self.update_dna(user_dna, article_dna, coeff, user_data.dna_update_algo)
-            log.info('updated:  ' + str(updated_dna))
-
-            # check for 'PE' and 'NE' (positive and negative engagement. pe engagement_mapping coeff > 0, ne, engagement mapping coeff < 0
-            engagements = cassandra_client.get_analytics(self.user_id, 100)
-            engagement_coeffs = [ 1 if engagement_mapping(json.loads(e[0]),1) > 0 else 0 for e in engagements ]
-
-            # need to double check if first 100 are most recent or last 100
-            if len(engagement_coeffs) < 100:
-                success_rate_100 = sum(engagement_coeffs) / len(engagement_coeffs)
-            else:
-                success_rate_100 = sum(engagement_coeffs[:100]) / len(engagement_coeffs[:100])
-
-            # need to double check if first 10 are most recent or last 10
-            if len(engagement_coeffs) < 10:
-                success_rate_10 = sum(engagement_coeffs) / len(engagement_coeffs)
-            else:
-                success_rate_10 = sum(engagement_coeffs[:10]) / len(engagement_coeffs[:10])
+            article = articles.get(data['article_id'])
+            if article is None:
+                log.warning('article not found for learning: ' + data['article_id'])
+                continue
 
-            if len(engagement_coeffs) < 100 and (success_rate_100 < .5 or success_rate_10 < .5):                
+            coeff = engagement_mapping(data, user_data.engagement_mapping)
+            article_dna = dna_vectors.article_dna(article).tolist()
+            user_dna = self.update_dna(user_dna, article_dna, coeff, user_data.dna_update_algo)
+
+        log.info('updated:  ' + str(user_dna))
+
+        # check for 'PE' and 'NE' (positive and negative engagement. pe engagement_mapping coeff > 0, ne, engagement mapping coeff < 0
+        # add_article_analytics pushed the engagements of this post before queueing it
+        engagement_bits, engagement_count = user_data.engagement_bits, user_data.engagement_count
+        if engagement_bits is None:
+            # users created before the ring buffer, seed it once from the stored history, which includes this post
+            engagements = cassandra_client.get_analytics(self.user_id, engagement_ring.ring_size)
+            engagement_bits, engagement_count = engagement_ring.from_history([ engagement_mapping(json.loads(e[0]),1) > 0 for e in engagements ])
+            cassandra_client.set_engagements(self.user_id, engagement_bits, engagement_count, None, user_data.engagement_count)
+
+        recent_count = min(engagement_count, 100)
+        if recent_count > 0:
+            success_rate_100 = engagement_ring.success_rate(engagement_bits, engagement_count, 100)
+            success_rate_10 = engagement_ring.success_rate(engagement_bits, engagement_count, 10)
+
+            if recent_count < 100 and (success_rate_100 < .5 or success_rate_10 < .5):
                 # perturb dna
-                for i in range(len(updated_dna)):
-                    val = updated_dna[i] + random.uniform(-0.1,0.1)
+                for i in range(len(user_dna)):
+                    val = user_dna[i] + random.uniform(-0.1,0.1)
                     if val > 1:
                         val = 1
                     if val < 0:
                         val = 0
-                    updated_dna[i] = val
-                    
-            elif len(engagement_coeffs) == 100 and success_rate_100 < .5:
+                    user_dna[i] = val
+
+            elif recent_count == 100 and success_rate_100 < .5:
                 # entirely reset dna
-                updated_dna = [0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5]
+                user_dna = [0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5]
 
+        cassandra_client.set_dna(self.user_id, user_dna)
 
         end = time.time()
         log.info('time to update dna: ' + str(end-start) + ' s.')
 
-        
-        
-    def serve(self, requested_count):
+    def serve(self, requested_count, user_data=None, served_filter=None):
 
         user_id = self.user_id
 
-        try:
-            user_data = cassandra_client.find_user(user_id)
-        except IndexError as e:
-            return None
+        if requested_count is None:
+            requested_count = max_count
+
+        if user_data is None:
+            try:
+                user_data = cassandra_client.find_user(user_id)
+            except IndexError as e:
+                return None
 
-        user_dna = json.loads(user_data[4])['dna']
+        user_dna = database.user_dna(user_data)
+
+        def find_served(article_ids):
+            try:
+                return cassandra_client.filter_served(user_id, article_ids, served_filter)
+            except TypeError:
+                return set()
+
+        # look-alike users share one ranking per candidate set, only served articles are removed per user
+        candidate_index.refresh()
+        version = (candidate_index.version, int(time.time() // memo_seconds))
+        key = (self.__class__.__name__, ranking_memo.fingerprint(user_dna))
+
+        ranked = None
+        if requested_count <= memo_depth:
+            ranked = ranking_memo.get(key, version)
+            if ranked is None and ranking_memo.remember(key):
+                ranked = self.rank(ranking_memo.centroid(key[1]), memo_depth, lambda article_ids: set())
+                ranking_memo.put(key, version, ranked)
+
+        if ranked is not None:
+            served = find_served([art.article_id for art in ranked])
+            articles = [ art for art in ranked if art.article_id not in served ][:requested_count]
+            if len(articles) == requested_count:
+                return [ candidates.response_doc(art) for art in articles ]
+
+        # too few unserved articles left in the shared ranking, rank for this user
+
+        return [ candidates.response_doc(art) for art in self.rank(user_dna, requested_count, find_served) ]
+
+    def rank(self, user_dna, requested_count, find_served):
+        """
+        Rank candidate articles for a dna
+
+        :param user_dna: list of floats, user dna
+        :param requested_count: int, number of articles wanted
+        :param find_served: function taking a list of candidate article ids, returns the set already served
+        :returns: list of up to requested_count candidate records, in serving order
+        """
+
+        # find 5 top categories in user dna
+        masks = bucket_masks(user_dna)
 
         final_articles_list = []
         article_ids_list = []
-        matched_article_count = 0
-        # search hour by hour for 4 hours
-        # then 4-12
-        # then 12-72
-        # then 72-144
-        time_deltas = [ datetime.timedelta(hours=1), datetime.timedelta(hours=1), datetime.timedelta(hours=1), datetime.timedelta(hours=1), datetime.timedelta(hours=8), datetime.timedelta(hours=60), datetime.timedelta(hours=72)]
-        current = datetime.datetime.utcnow()
-        for delta in time_deltas:
-            articles = []
-            start_time = current - delta
-
-            for art in collection.find({"timestamp": {"$gte": start_time, "$lt": current}}):
-
-                if art['full_text'] is None:
-                    continue
 
-                try:
-                    if not cassandra_client.check_if_served(self.user_id, art['article_id']):
-                        shortened_doc = {k: v for k, v in art.items() if not k in ['_id', 'author', 'summary', 'links', 'full_text']}
-                        shortened_doc['link'] = art['links'][0]
-                        articles.append(shortened_doc)
-                except TypeError:
-                    shortened_doc = {k: v for k, v in art.items() if not k in ['_id', 'author', 'summary', 'links', 'full_text']}
-                    shortened_doc['link'] = art['links'][0]
-                    articles.append(shortened_doc)
-
-                     
-            # find 5 top categories in user dna
-            user_dna_copy = list(user_dna)
-            top_buckets = []
-            for i in range(5):
-                top_buckets.append(topic_to_bucket[index_to_topic[user_dna_copy.index(max(user_dna_copy))]])
-                for category in top_buckets[-1]:
-                    user_dna_copy[topic_to_index[category]] = 0
-            
-            
-            all_topics = [[], [], [], [], [], []]
-            for art in articles:
-                art_dna = article_to_dna_mapping(art['topics']['text_razor'])
-                
-                # find top article
-                all_topics[0].append((inner_product(art_dna, user_dna), art['article_id']))
-                
-                # find top articles in zero'ed out categories
-                count = 1
-                for bucket in top_buckets:
-                    art_dna_copy = list(art_dna)
-                    for category in bucket:
-                        art_dna_copy[topic_to_index[category]] = 0
-                    all_topics[count].append((inner_product(art_dna_copy, user_dna), art['article_id']))
-                    count += 1
-                
-            # create alternating stream of articles in different categories
-            #log.info(all_topics)
-            for scores in all_topics:
-                scores.sort(key=lambda x: x[0], reverse=True)
+        now = datetime.datetime.utcnow()
+        candidate_index.refresh()
+        article_ids, timestamps, matrix = candidate_columns(now - candidates.serve_window, now)
 
-            #log.info(all_topics)
-            # only guarantees alternating buckets if there are enough articles in current time bucket
-            for topic in all_topics:
+        served = find_served(article_ids)
+        available = servable(article_ids, served)
 
-                if len(topic) == 0:
+        # overall ranking + five zero'ed out buckets
+        weights = masks * np.asarray(user_dna, dtype=float)
+
+        for start, end in candidates.window_bounds(now):
+
+            lo, hi = np.searchsorted(timestamps, [article_store.to_epoch(start), article_store.to_epoch(end)])
+
+            if hi - lo > topk_min_candidates:
+                # large windows, only read the topic postings as far as needed
+                top_articles = []
+                for ranking in weights:
+                    top_articles += top_unserved(ranking, start, end, served, find_served)
+
+            else:
+                if not available[lo:hi].any():
                     continue
 
-                top_item = topic.pop(0)
-                if collection.find({'article_id': top_item[1]}).count() > 1:
-                    log.warning('Non-unique article_id found: ' + top_item[1])
-                    
-                for doc in collection.find({'article_id': top_item[1]}):
-                    art = doc
-                shortened_doc = {k: v for k, v in art.items() if not k in ['_id', 'author', 'timestamp', 'topics', 'summary', 'links', 'full_text']}
-                shortened_doc['link'] = art['links'][0]
+                # one row per candidate, one column per ranking
+                scores = score_articles(matrix[lo:hi], user_dna, masks)
+                scores[~available[lo:hi]] = -np.inf
+                top_articles = [ candidate_index.get(article_ids[lo + index]) for index in np.argmax(scores, axis=0) ]
 
-                if shortened_doc['article_id'] not in article_ids_list:
-                    final_articles_list.append(shortened_doc)
-                    article_ids_list.append(shortened_doc['article_id'])
+            # create alternating stream of articles in different categories
+            # only guarantees alternating buckets if there are enough articles in current time bucket
+            for art in top_articles:
+
+                if art is not None and art.article_id not in article_ids_list:
+                    final_articles_list.append(art)
+                    article_ids_list.append(art.article_id)
 
                 if len(final_articles_list) == requested_count:
                     return final_articles_list
-                            
-            current -= delta
 
         return final_articles_list
+
+
+def top_unserved(weights, start, end, served, find_served):
+    """
+    Best article of a time window from the topic postings that was not served.  served
+    only covers the scored columns, so the article top_k picks is checked before it is
+    taken and the search goes on without it if it was served
+
+    :param weights: numpy array of 20 weights, one ranking of the masked user dna
+    :param start: datetime, start of the window (inclusive)
+    :param end: datetime, end of the window (exclusive)
+    :param served: set of article ids known to be served, articles found served are added
+    :param find_served: function taking a list of candidate article ids, returns the set already served
+    :returns: list of at most one Candidate
+    """
+
+    while True:
+        top_articles = candidate_index.top_k(weights, start, end, accept=lambda art: art.article_id not in served)
+        found = find_served([ art.article_id for art in top_articles ]) if len(top_articles) > 0 else set()
+        if len(found) == 0:
+            return top_articles
+        served.update(found)
+
+
+def top_indices(scores, k):
+    """
+    Indices of the k best rows of every column, found with a partial selection instead of
+    sorting all rows
+
+    :param scores: numpy array n x m
+    :param k: int, 1 <= k <= n
+    :returns: numpy array k x m, row i holds the index of the (i+1)-th best score of each column
+    """
+
+    columns = np.arange(scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=0)[:k]
+    order = np.argsort(-scores[top, columns], axis=0, kind='mergesort')
+    return top[order, columns]
+
+
+# Single pass variant:  one scoring pass over the whole 144h window with recency decay
+class DecayedWeightedAverage(WeightedAverage):
+    """
+    WeightedAverage walks up to seven time windows per request.  This variant scores the
+    full candidate set once, weights every score by 0.5 ** (age / half_life) and picks the
+    top articles of each ranking with a partial selection.
+    """
+
+    # hours for the recency weight to halve
+    half_life = 12.0
+
+    # weight of the article popularity added to the dna score, see PopularWeightedAverage
+    popularity_weight = 0.0
+
+    def rank(self, user_dna, requested_count, find_served):
+
+        # find 5 top categories in user dna
+        masks = bucket_masks(user_dna)
+
+        now = datetime.datetime.utcnow()
+        candidate_index.refresh()
+        article_ids, timestamps, matrix = candidate_columns(now - candidates.serve_window, now)
+
+        served = find_served(article_ids)
+        available = servable(article_ids, served)
+
+        count = int(available.sum())
+        if count == 0 or requested_count <= 0:
+            return []
+
+        ages = (article_store.to_epoch(now) - timestamps) / 3600.0
+        decay = 0.5 ** (np.maximum(ages, 0) / self.half_life)
+
+        # one row per candidate, one column per ranking (overall + five zero'ed out buckets)
+        scores = score_articles(matrix, user_dna, masks)
+        if self.popularity_weight > 0:
+            scores += self.popularity_weight * popularity(article_ids)[:, np.newaxis]
+        scores *= decay[:, np.newaxis]
+        scores[~available] = -np.inf
+
+        # rankings can pick the same article, look deeper only when the first rounds are not enough
+        k = min(count, requested_count)
+        while True:
+            final_articles_list = []
+            chosen = set()
+
+            # create alternating stream of articles in different categories
+            for row in top_indices(scores, k):
+                for index in row:
+                    art = candidate_index.get(article_ids[index])
+                    if art is not None and art.article_id not in chosen:
+                        final_articles_list.append(art)
+                        chosen.add(art.article_id)
+
+                    if len(final_articles_list) == requested_count:
+                        return final_articles_list
+
+            if k == count:
+                return final_articles_list
+
+            k = min(count, 2*k)
+
+
+# Popularity variant:  recency decayed scores blended with the engagement of all users
+class PopularWeightedAverage(DecayedWeightedAverage):
+    """
+    Adds popularity_weight times the share of positive engagements of an article, smoothed
+    towards 0.5 while it has few engagements, to its dna score before the recency decay.
+    Counts come from the engagement counters mirrored in the candidate index, no history
+    is read per request.
+    """
+
+    popularity_weight = 0.5
+
+
+# users scored in one matrix product by serve_batch, bounds the scores array to
+# window articles x 6*batch_block_users floats
+batch_block_users = 64
+
+# article serve algorithms serve_batch hands users to one at a time, algorithm 1 users are
+# scored together
+single_serve_algos = {2: DecayedWeightedAverage, 3: PopularWeightedAverage}
+
+
+def serve_batch(user_ids, requested_count):
+    """
+    Serve articles to many users at once, for push notification and digest jobs.
+
+    The candidate window is loaded once and the users are scored in blocks of
+    batch_block_users, each in one matrix product: the candidates of a window against the
+    stacked, bucket masked dna of the block.  Each user gets the list WeightedAverage.serve
+    would build for them, with the same served filtering and alternating buckets.  Users
+    of the decayed and popularity algorithms are served by their own algorithm.
+
+    :param user_ids: list of strings, user uuids
+    :param requested_count: int, number of articles per user
+    :returns: dict user_id -> list of article dicts, None for unknown users
+    """
+
+    results = {}
+
+    # every user's row and served filter are read at once, not one user after the other
+    futures = {}
+    for user_id in user_ids:
+        try:
+            futures[user_id] = (cassandra_client.find_user_async(user_id), cassandra_client.get_served_filter_async(user_id))
+        except ValueError:
+            results[user_id] = None
+
+    users = []
+    weights = []
+    served_filters = {}
+    for user_id in user_ids:
+        if user_id in results:
+            continue
+
+        user_future, served_filter_future = futures[user_id]
+        try:
+            user_data = user_future.result()
+        except IndexError:
+            results[user_id] = None
+            continue
+
+        if user_data.article_serve_algo in single_serve_algos:
+            results[user_id] = single_serve_algos[user_data.article_serve_algo](user_id).serve(requested_count, user_data, served_filter_future.result())
+            continue
+        elif user_data.article_serve_algo != 1:
+            log.warning('unsupported article serving algorithm ' + str(user_data.article_serve_algo) + ' for ' + user_id)
+            results[user_id] = None
+            continue
+
+        results[user_id] = []
+        users.append(user_id)
+        served_filters[user_id] = served_filter_future
+
+        user_dna = database.user_dna(user_data)
+        # one row per user and ranking: overall + five zero'ed out buckets
+        weights.append(bucket_masks(user_dna) * np.asarray(user_dna, dtype=float))
+
+    if len(users) == 0:
+        return results
+
+    weights = np.vstack(weights)
+
+    now = datetime.datetime.utcnow()
+    candidate_index.refresh()
+    article_ids, timestamps, matrix = candidate_columns(now - candidates.serve_window, now)
+    # articles not loaded in the index yet have no response fields
+    missing = ~servable(article_ids, set())
+
+    # the users_served reads of all users are in flight together as well
+    served_futures = { user_id: cassandra_client.filter_served_async(user_id, article_ids, served_filters[user_id].result()) for user_id in users }
+    served = {}
+    for user_id in users:
+        try:
+            served[user_id] = served_futures[user_id].result()
+        except TypeError:
+            served[user_id] = set()
+
+    active = list(range(len(users)))
+    for start, end in candidates.window_bounds(now):
+
+        lo, hi = np.searchsorted(timestamps, [article_store.to_epoch(start), article_store.to_epoch(end)])
+        if hi == lo:
+            continue
+
+        positions = {article_id: row for row, article_id in enumerate(article_ids[lo:hi])}
+
+        still_active = []
+        for block_start in range(0, len(active), batch_block_users):
+            block = active[block_start:block_start + batch_block_users]
+
+            rows = np.concatenate([ np.arange(6*u, 6*u + 6) for u in block ])
+            scores = np.dot(matrix[lo:hi], weights[rows].T)
+            scores[missing[lo:hi]] = -np.inf
+
+            for column, u in enumerate(block):
+                served_rows = [ positions[article_id] for article_id in served[users[u]] if article_id in positions ]
+                if len(served_rows) > 0:
+                    scores[served_rows, 6*column:6*column + 6] = -np.inf
+
+            top = np.argmax(scores, axis=0)
+
+            for column, u in enumerate(block):
+                final_articles_list = results[users[u]]
+                for ranking in range(6*column, 6*column + 6):
+                    art = candidate_index.get(article_ids[lo + top[ranking]])
+                    if scores[top[ranking], ranking] == -np.inf or art is None:
+                        continue
+
+                    if art.article_id not in [doc['article_id'] for doc in final_articles_list]:
+                        final_articles_list.append(candidates.response_doc(art))
+
+                    if len(final_articles_list) == requested_count:
+                        break
+
+                if len(final_articles_list) < requested_count:
+                    still_active.append(u)
+
+        active = still_active
+        if len(active) == 0:
+            break
+
+    return results
@@ -0,0 +1,433 @@
+"""
+candidates.py
+in-process index of the articles that can be served
+
+serve used to run one mongo range query per time window on every request.  the index
+keeps the servable articles of the last 144 hours in memory instead, sorted by
+timestamp so each time window is a slice.  it is refreshed incrementally from the
+_id of the last document it loaded and evicts articles as they age out of the window.
+
+the index also keeps a topic inverted index: for every topic and hour slot, the articles
+with a non-zero score for that topic sorted by score.  top_k uses it to find the best
+articles of a time window with the threshold algorithm, reading only as far down the
+topic lists as needed instead of scoring every candidate.
+"""
+
+import bisect
+import datetime
+import dna_vectors
+import heapq
+import itertools
+import logging
+import numpy as np
+import threading
+import time
+
+log = logging.getLogger('noozli_api')
+
+# search hour by hour for 4 hours
+# then 4-12
+# then 12-72
+# then 72-144
+time_deltas = [ datetime.timedelta(hours=1), datetime.timedelta(hours=1), datetime.timedelta(hours=1), datetime.timedelta(hours=1), datetime.timedelta(hours=8), datetime.timedelta(hours=60), datetime.timedelta(hours=72)]
+
+serve_window = sum(time_deltas, datetime.timedelta(0))
+
+# only the fields needed for scoring and for the articles response are read from mongo
+candidate_fields = {'article_id': True, 'timestamp': True, 'topics': True, 'dna': True, 'title': True, 'image': True, 'published': True, 'source': True, 'links': True}
+
+# fields returned to the client for each served article
+response_fields = ['article_id', 'display_text', 'image', 'link', 'published', 'source', 'title']
+
+# fields returned in list mode, the body is fetched separately when the article is opened
+list_fields = ['article_id', 'image', 'link', 'published', 'source', 'title']
+
+
+# width of the time slots the topic postings are partitioned into
+slot_seconds = 3600
+
+epoch = datetime.datetime(1970, 1, 1)
+
+
+def time_slot(timestamp):
+    return int((timestamp - epoch).total_seconds() // slot_seconds)
+
+
+def window_bounds(now):
+    """
+    Start and end of each time_deltas window, most recent window first
+
+    :param now: datetime, utc time the windows are measured back from
+    :returns: list of (start, end) datetime tuples
+    """
+
+    bounds = []
+    current = now
+    for delta in time_deltas:
+        bounds.append((current - delta, current))
+        current -= delta
+    return bounds
+
+
+# marks response fields the article document does not have
+missing = object()
+
+
+class Candidate:
+    """
+    Article record kept in the index.  Only what ranking reads is an attribute, the
+    response fields stay a tuple in response_fields order until the article is served.
+    """
+
+    __slots__ = ['article_id', 'timestamp', 'dna', 'fields', 'fragment', 'list_fragment', 'positive', 'negative']
+
+    def __init__(self, doc):
+        """
+        :param doc: dict, article document read with candidate_fields
+        """
+
+        self.article_id = doc['article_id']
+        self.timestamp = doc['timestamp']
+        self.dna = dna_vectors.article_dna(doc)
+        self.fields = tuple(doc['links'][0] if k == 'link' else doc.get(k, missing) for k in response_fields)
+        # response json of this record in full and list mode, encoded by the api on first serve
+        self.fragment = None
+        self.list_fragment = None
+        # engagement counts, see CandidateIndex.load_engagement
+        self.positive = 0
+        self.negative = 0
+
+    def popularity(self):
+        """
+        :returns: float, share of positive engagements smoothed towards 0.5 for articles with few engagements
+        """
+
+        return (self.positive + 1.0) / (self.positive + self.negative + 2.0)
+
+
+def response_doc(art, fields=response_fields):
+    """
+    Build the response dict for a served article from its candidate record
+
+    :param art: Candidate from the candidate index
+    :param fields: list of strings, response_fields or list_fields
+    :returns: dict with only the fields sent to the client
+    """
+
+    return {k: v for k, v in zip(response_fields, art.fields) if v is not missing and k in fields}
+
+
+class CandidateIndex:
+    """
+    Servable articles of the last 144 hours, shared by all request threads
+    """
+
+    def __init__(self, collection, bodies=None, max_articles=20000, refresh_interval=60, engagement=None, engagement_interval=300):
+        """
+        :param collection: mongo collection article metadata is inserted into
+        :param bodies: mongo collection the article bodies are inserted into, display_text is
+                       read from the article documents themselves if None
+        :param max_articles: int, memory cap, oldest articles are evicted first
+        :param refresh_interval: int, seconds between incremental refreshes
+        :param engagement: function taking a list of article ids, returns a dict article_id -> (positive, negative)
+                           engagement counts.  counts are not loaded if None
+        :param engagement_interval: int, seconds between reloads of the engagement counts
+        """
+
+        self.collection = collection
+        self.bodies = bodies
+        self.max_articles = max_articles
+        self.refresh_interval = refresh_interval
+        self.engagement = engagement
+        self.engagement_interval = engagement_interval
+        self.last_engagement = 0
+
+        # timestamps and articles are parallel lists sorted by timestamp
+        self.timestamps = []
+        self.articles = []
+        # article_id -> Candidate
+        self.article_ids = {}
+
+        # (topic index, time slot) -> list of (-topic score, sequence, article) sorted best first.
+        # lists are replaced, never modified in place, so readers need no lock
+        self.postings = {}
+        self.sequence = itertools.count()
+
+        # _id of the newest document loaded, ObjectIds increase with insertion time
+        self.watermark = None
+        self.last_refresh = 0
+        self.version = 0
+
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """
+        Load articles inserted since the last refresh and evict aged out ones
+
+        :param force: bool, refresh even if refresh_interval has not passed
+        """
+
+        if not force and time.time() - self.last_refresh < self.refresh_interval:
+            return
+
+        # one thread refreshes, the others keep serving from the current index
+        # unless nothing has been loaded yet
+        if not self.refresh_lock.acquire(blocking=force or self.last_refresh == 0):
+            return
+
+        try:
+            if not force and time.time() - self.last_refresh < self.refresh_interval:
+                return
+
+            now = datetime.datetime.utcnow()
+            query = {'timestamp': {'$gte': now - serve_window}, 'has_text': True}
+            if self.watermark is not None:
+                query['_id'] = {'$gt': self.watermark}
+
+            fields = candidate_fields if self.bodies is not None else dict(candidate_fields, display_text=True)
+            docs = list(self.collection.find(query, fields).sort('_id', 1))
+            watermark = docs[-1]['_id'] if len(docs) > 0 else self.watermark
+
+            if self.bodies is not None and len(docs) > 0:
+                # one query for the display_text of all new articles
+                texts = {}
+                for body in self.bodies.find({'article_id': {'$in': [ art['article_id'] for art in docs ]}}, {'article_id': True, 'display_text': True}):
+                    texts[body['article_id']] = body['display_text']
+
+                for art in docs:
+                    if art['article_id'] in texts:
+                        art['display_text'] = texts[art['article_id']]
+                    else:
+                        log.warning('No body found for article_id: ' + art['article_id'])
+
+            new_articles = [ Candidate(art) for art in docs if self.bodies is None or 'display_text' in art ]
+
+            with self.lock:
+                inserted = []
+                for art in new_articles:
+                    if art.article_id in self.article_ids:
+                        log.warning('Non-unique article_id found: ' + art.article_id)
+                        continue
+
+                    position = bisect.bisect_right(self.timestamps, art.timestamp)
+                    self.timestamps.insert(position, art.timestamp)
+                    self.articles.insert(position, art)
+                    self.article_ids[art.article_id] = art
+                    inserted.append(art)
+
+                evicted = self.evict(now)
+                self.update_postings(inserted, evicted)
+                self.watermark = watermark
+                # rankings computed before must not serve evicted articles either
+                if len(inserted) > 0 or len(evicted) > 0:
+                    self.version += 1
+
+            if self.engagement is not None and time.time() - self.last_engagement >= self.engagement_interval:
+                self.load_engagement()
+
+            self.last_refresh = time.time()
+
+        finally:
+            self.refresh_lock.release()
+
+    def load_engagement(self):
+        """
+        Replace the engagement counts of all candidates with the stored counters, which
+        include the engagements posted to other processes
+        """
+
+        try:
+            counts = self.engagement(list(self.article_ids))
+        except Exception as e:
+            log.warning('Failed to load engagement counts: ' + str(e))
+            return
+
+        for art in list(self.article_ids.values()):
+            art.positive, art.negative = counts.get(art.article_id, (0, 0))
+
+        # popularity scores changed
+        with self.lock:
+            self.version += 1
+
+        self.last_engagement = time.time()
+
+    def add_engagement(self, article_id, positive):
+        """
+        Count an engagement posted to this process right away, until the next load_engagement
+
+        :param article_id: string
+        :param positive: bool, True for a positive engagement
+        """
+
+        art = self.article_ids.get(article_id)
+        if art is None:
+            return
+
+        if positive:
+            art.positive += 1
+        else:
+            art.negative += 1
+
+    def evict(self, now):
+        """
+        Drop articles older than the serve window, then the oldest ones above max_articles.
+        Caller must hold self.lock.
+
+        :param now: datetime, current utc time
+        :returns: list of evicted Candidates
+        """
+
+        cutoff = bisect.bisect_left(self.timestamps, now - serve_window)
+        cutoff = max(cutoff, len(self.timestamps) - self.max_articles)
+        if cutoff <= 0:
+            return []
+
+        evicted = self.articles[:cutoff]
+        for art in evicted:
+            self.article_ids.pop(art.article_id, None)
+        del self.timestamps[:cutoff]
+        del self.articles[:cutoff]
+
+        return evicted
+
+    def update_postings(self, inserted, evicted):
+        """
+        Add new articles to and drop evicted articles from the topic postings.
+        Caller must hold self.lock.
+
+        :param inserted: list of Candidates added to the index
+        :param evicted: list of Candidates removed from the index
+        """
+
+        changed = {}
+        for art in inserted:
+            slot = time_slot(art.timestamp)
+            for topic in np.flatnonzero(art.dna):
+                entry = (-float(art.dna[topic]), next(self.sequence), art)
+                changed.setdefault((int(topic), slot), []).append(entry)
+
+        dropped = set()
+        for art in evicted:
+            slot = time_slot(art.timestamp)
+            for topic in np.flatnonzero(art.dna):
+                changed.setdefault((int(topic), slot), [])
+                dropped.add(art.article_id)
+
+        if len(changed) == 0:
+            return
+
+        postings = dict(self.postings)
+        for key, entries in changed.items():
+            merged = sorted(entry for entry in postings.get(key, []) + entries if entry[2].article_id not in dropped)
+            if len(merged) > 0:
+                postings[key] = merged
+            else:
+                postings.pop(key, None)
+        self.postings = postings
+
+    def get(self, article_id):
+        """
+        :param article_id: string
+        :returns: Candidate or None if the article is not in the index
+        """
+
+        return self.article_ids.get(article_id)
+
+    def __contains__(self, article_id):
+        return article_id in self.article_ids
+
+    def top_k(self, weights, start, end, k=1, accept=None):
+        """
+        Best articles of a time window for a weight vector, using the threshold algorithm
+        over the topic postings.  Each topic contributes one stream of its articles in the
+        window, best first.  Streams are read round robin and stop as soon as the k-th best
+        score found is at least the best score any unread article could still reach.
+
+        Articles that score zero are not in any weighted stream, if fewer than k articles
+        score above zero the rest are filled with the earliest accepted articles of the window.
+
+        :param weights: numpy array of 20 non-negative weights, e.g. a masked user dna
+        :param start: datetime, start of the window (inclusive)
+        :param end: datetime, end of the window (exclusive)
+        :param k: int, number of articles wanted
+        :param accept: function taking a Candidate, False to skip it (e.g. already served)
+        :returns: list of up to k Candidates, best first
+        """
+
+        postings = self.postings
+        slots = range(time_slot(start), time_slot(end) + 1)
+
+        streams = []
+        for topic in np.flatnonzero(weights):
+            lists = [ postings[(topic, slot)] for slot in slots if (topic, slot) in postings ]
+            if len(lists) > 0:
+                streams.append([float(weights[topic]), heapq.merge(*lists), 0.0])
+
+        best = []
+        seen = set()
+        while len(streams) > 0:
+            for stream in list(streams):
+                entry = next(stream[1], None)
+                if entry is None:
+                    streams.remove(stream)
+                    continue
+
+                # nothing further down this stream scores higher on its topic
+                stream[2] = -entry[0]
+                art = entry[2]
+                if art.article_id in seen or not (start <= art.timestamp < end):
+                    continue
+                seen.add(art.article_id)
+
+                if accept is not None and not accept(art):
+                    continue
+
+                score = float(np.dot(weights, art.dna))
+                if len(best) < k:
+                    heapq.heappush(best, (score, -entry[1], art))
+                elif score > best[0][0]:
+                    heapq.heapreplace(best, (score, -entry[1], art))
+
+            threshold = sum(stream[0] * stream[2] for stream in streams)
+            if len(best) == k and best[0][0] >= threshold:
+                break
+
+        result = [ item[2] for item in sorted(best, key=lambda item: item[:2], reverse=True) ]
+
+        if len(result) < k:
+            chosen = set(art.article_id for art in result)
+            for art in self.window(start, end):
+                if len(result) == k:
+                    break
+                if art.article_id not in chosen and (accept is None or accept(art)):
+                    result.append(art)
+
+        return result
+
+    def window(self, start, end):
+        """
+        Candidate articles with start <= timestamp < end, oldest first
+
+        :param start: datetime, start of the window (inclusive)
+        :param end: datetime, end of the window (exclusive)
+        :returns: list of Candidates
+        """
+
+        with self.lock:
+            return self.articles[bisect.bisect_left(self.timestamps, start):bisect.bisect_left(self.timestamps, end)]
+
+    def windows(self, now=None):
+        """
+        Candidate articles bucketed by time_deltas, most recent window first
+
+        :param now: datetime, utc time the windows are measured back from
+        :returns: list of lists of Candidates, one list per entry in time_deltas
+        """
+
+        self.refresh()
+
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        return [ self.window(start, end) for start, end in window_bounds(now) ]
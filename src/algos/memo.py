@@ -0,0 +1,88 @@
+"""
+memo.py
+rankings shared by users with (nearly) the same dna
+
+every new user starts with the same dna and many users stay close to each other, so the
+ranking of the candidate set is computed once per quantized dna and reused.  per user
+only the served articles are removed from the shared ranking.  rankings are dropped as
+soon as the version they were computed for changes, e.g. when the candidate set changes.
+"""
+
+import collections
+import threading
+
+
+class RankingMemo:
+
+    def __init__(self, max_entries=1000, step=0.05, max_seen=10000):
+        """
+        :param max_entries: int, rankings kept, least recently used are dropped first
+        :param step: float, dna values are rounded to multiples of step for the fingerprint
+        :param max_seen: int, fingerprints remembered to decide which rankings are worth keeping
+        """
+
+        self.max_entries = max_entries
+        self.step = step
+        self.max_seen = max_seen
+
+        self.entries = collections.OrderedDict()
+        self.seen = collections.OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+
+    def fingerprint(self, dna):
+        return tuple(int(round(value / self.step)) for value in dna)
+
+    def centroid(self, fingerprint):
+        """
+        :returns: list of floats, the dna every user with this fingerprint is ranked for
+        """
+
+        return [ value * self.step for value in fingerprint ]
+
+    def get(self, key, version):
+        """
+        :param key: hashable, e.g. (algorithm name, dna fingerprint)
+        :param version: version of the candidate set the ranking must have been computed for, compared with ==
+        :returns: list of candidate records or None
+        """
+
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+                return None
+
+            ranked = self.entries.get(key)
+            if ranked is not None:
+                self.entries.move_to_end(key)
+            return ranked
+
+    def remember(self, key):
+        """
+        Record a request for key
+
+        :returns: True if key was requested before, i.e. at least two look-alike requests
+                  share it and a ranking is worth computing and keeping
+        """
+
+        with self.lock:
+            if key in self.seen:
+                self.seen.move_to_end(key)
+                return True
+
+            self.seen[key] = True
+            while len(self.seen) > self.max_seen:
+                self.seen.popitem(last=False)
+            return False
+
+    def put(self, key, version, ranked):
+
+        with self.lock:
+            if version != self.version:
+                return
+
+            self.entries[key] = ranked
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
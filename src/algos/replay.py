@@ -0,0 +1,99 @@
+"""
+replay.py
+recompute user dna from the stored engagement history, many users at once
+
+algo.engagement_mapping and WeightedAverage.update_dna handle one article of one user at
+a time.  the versions here take the events of a whole batch of users as numpy arrays:
+the coefficients of all events are mapped in one pass and the dna of all users is
+updated in lockstep, one step per event, with the users that have no events left
+dropping out.  tools/replay_dna.py uses them to retrain every user after the mapping
+coefficients or the update rule change.
+
+the random perturbation and the reset learn applies after a post are not replayed, the
+result is the dna the engagement history gives under the current rules.
+"""
+
+import numpy as np
+
+# dna of a new user, see database.create_user
+initial_dna = 0.5
+
+
+def engagement_coeffs(analytics, algo):
+    """
+    Map the engagement analytics of many articles to weighting coefficients, same values
+    as algo.engagement_mapping
+
+    :param analytics: list of dicts containing analytics for an article
+    :param algo: int selecting from different engagement mapping algorithms
+    :returns: array of floats, one weighting coefficient per article
+    """
+
+    if algo == 1:
+
+        shared = np.array([ len(data['share']) > 0 for data in analytics ], dtype=bool)
+        saved = np.array([ data['action'] == 'save' for data in analytics ], dtype=bool)
+        down = np.array([ data['down'] for data in analytics ], dtype=float)
+        total_time = np.array([ data['total_time'] for data in analytics ], dtype=float)
+        percent = np.array([ data['percent'] for data in analytics ], dtype=float)
+
+        # first matching condition wins, in the order engagement_mapping checks them
+        conditions = [
+            shared,
+            saved,
+            (down > 0) & (total_time > 60) & (down >= 3) & (percent > 85),
+            (down > 0) & (total_time > 20),
+            down > 0,
+        ]
+        return np.select(conditions, [0.5, 0.0625, .4375, 0.3125, 0.125], default=0.0)
+
+    else:
+        raise ValueError('algorithm value not supported: %d', algo)
+
+
+def replay_dna(events, article_dna, algo):
+    """
+    Compute the dna of many users from their engagements, same result as applying
+    WeightedAverage.update_dna to each engagement in order starting from a new user's dna
+
+    :param events: list of (article_rows, coeffs) per user, oldest engagement first.
+                   article_rows are int arrays indexing article_dna, coeffs the
+                   engagement_coeffs of the same engagements
+    :param article_dna: (articles, dna_length) array of article dna
+    :param algo: int, choose between different update algos
+    :returns: (users, dna_length) array, dna of each user in the order of events
+    """
+
+    if algo != 1:
+        raise ValueError('algorithm value not supported: %d', algo)
+
+    lengths = np.array([ len(rows) for rows, coeffs in events ], dtype=np.int64)
+
+    # users with the most events first, at step t the users still replaying are a prefix
+    order = np.argsort(-lengths, kind='mergesort')
+    sorted_lengths = lengths[order]
+    offsets = np.zeros(len(events), dtype=np.int64)
+    np.cumsum(sorted_lengths[:-1], out=offsets[1:])
+
+    rows = np.concatenate([ np.asarray(events[i][0], dtype=np.int64) for i in order ] + [np.zeros(0, dtype=np.int64)])
+    coeffs = np.concatenate([ np.asarray(events[i][1], dtype=float) for i in order ] + [np.zeros(0)])
+
+    steps = int(sorted_lengths[0]) if len(events) > 0 else 0
+    active = len(events) - np.searchsorted(sorted_lengths[::-1], np.arange(steps), side='right')
+
+    dna = np.full((len(events), article_dna.shape[1]), initial_dna)
+    for t in range(steps):
+        n = active[t]
+        index = offsets[:n] + t
+        user_dna = dna[:n]
+        art = article_dna[rows[index]]
+        coeff = coeffs[index][:, np.newaxis]
+
+        # if user did not engage with article, reduce those categories
+        reduced = np.where(art > 0, 0.0625*user_dna, user_dna)
+        averaged = (1.0-coeff)*user_dna + coeff*art
+        dna[:n] = np.where(coeff == 0, reduced, averaged)
+
+    result = np.empty_like(dna)
+    result[order] = dna
+    return result
@@ -1,15 +1,17 @@
 import flask
 from flask import Flask
+import hmac
 from flask.ext import restful
 from flask.ext.restful import reqparse
 
 import database
-import multiprocessing
+import learner
 import pymongo
 import json
 import logging
 import logger
 import os
+import prefetch
 import uuid
 import time
 import sys
@@ -18,6 +20,7 @@ import subprocess
 sys.path.append(os.path.dirname(os.path.realpath(__file__))+'/algos')
 
 import algo
+import candidates
 
 log = logging.getLogger('noozli_api')
 log.setLevel(logging.INFO)
@@ -39,6 +42,7 @@ except Exception as e:
     
 db = mongo_client.noozli
 collection = db.streaming
+bodies = db.bodies
 
 try:
     cassandra_client = database.NoozliClient()
@@ -46,6 +50,88 @@ try:
 except Exception as e:
     log.warning('Failed to connect to cassandra.')
 
+def article_server(user_id, article_algo):
+
+    if article_algo == 1:
+        return algo.WeightedAverage(user_id)
+    elif article_algo == 2:
+        return algo.DecayedWeightedAverage(user_id)
+    elif article_algo == 3:
+        return algo.PopularWeightedAverage(user_id)
+    else:
+        raise RuntimeError("unsupported article serving algorithm "+str(article_algo))
+
+def compute_page(user_id, count):
+    """
+    compute the next page of articles for a user in the background, see prefetch.PageCache
+    """
+
+    version = algo.candidate_index.version
+    user_data = cassandra_client.find_user(user_id)
+    articles = article_server(user_id, user_data.article_serve_algo).serve(count, user_data)
+    return articles, database.user_dna(user_data), version
+
+page_cache = prefetch.PageCache(compute_page)
+
+# dna updates run behind the analytics post, the next page is prefetched once the dna changed
+learning = learner.Learner(algo.learn, done=page_cache.schedule)
+
+# shared secret for internal endpoints used by push and digest jobs
+try:
+    with open(os.path.dirname(os.path.realpath(__file__)) + '/../config/keys.json', 'r') as keys_f:
+        batch_api_key = json.loads(keys_f.read()).get('batch_api_key')
+except (IOError, ValueError) as e:
+    batch_api_key = None
+    log.warning('Failed to load batch api key, batch endpoints disabled.')
+
+# largest number of users a single batch request may ask for
+max_batch_users = 1000
+
+# seconds clients and caches in front of the api may keep an article body
+article_body_max_age = 86400
+
+def article_fragment(art, list_mode=False):
+    """
+    json of one served article, encoded once per candidate record and reused for every
+    user the article is served to
+
+    :param art: dict, response doc of an article
+    :param list_mode: bool, only encode candidates.list_fields
+    :returns: bytes, same encoding flask.jsonify uses for the article
+    """
+
+    fields = candidates.list_fields if list_mode else candidates.response_fields
+
+    candidate = algo.candidate_index.get(art['article_id'])
+    if candidate is None:
+        return str.encode(flask.json.dumps({k: art[k] for k in fields if k in art}, separators=(',', ':')))
+
+    fragment = candidate.list_fragment if list_mode else candidate.fragment
+    if fragment is None:
+        fragment = str.encode(flask.json.dumps(candidates.response_doc(candidate, fields), separators=(',', ':')))
+        if list_mode:
+            candidate.list_fragment = fragment
+        else:
+            candidate.fragment = fragment
+    return fragment
+
+def articles_response(articles, list_mode=False):
+    """
+    Same response as flask.jsonify({'count': len(articles), 'articles': articles}), the body
+    is joined from the cached article fragments instead of encoding every article again
+
+    :param articles: list of response docs
+    :param list_mode: bool, only return candidates.list_fields of each article
+    """
+
+    if app.debug or app.config['JSONIFY_PRETTYPRINT_REGULAR'] or not app.config['JSON_SORT_KEYS']:
+        if list_mode:
+            articles = [ {k: art[k] for k in candidates.list_fields if k in art} for art in articles ]
+        return flask.jsonify({'count': len(articles), 'articles': articles})
+
+    body = b'{"articles":[' + b','.join(article_fragment(art, list_mode) for art in articles) + b'],"count":' + str.encode(str(len(articles))) + b'}\n'
+    return app.response_class(body, mimetype=app.config['JSONIFY_MIMETYPE'])
+
 def make_error(status_code, message):
 
     response = flask.jsonify({'status':  status_code, 'message': message})
@@ -68,15 +154,17 @@ class ArticlesTest(restful.Resource):
 
         counter = 0
         articles = []
-        for doc in collection.find():
+        for doc in collection.find({'has_text': True}):
             
             if counter == count:
                 break
 
-            if doc['full_text'] is None:
+            body = bodies.find_one({'article_id': doc['article_id']}, {'display_text': True})
+            if body is None:
                 continue
             
-            shortened_doc = {k: v for k, v in doc.items() if not k in ['_id', 'topics', 'timestamp', 'author', 'summary', 'links', 'full_text']}
+            shortened_doc = {k: v for k, v in doc.items() if not k in ['_id', 'topics', 'timestamp', 'author', 'links', 'dna', 'has_text']}
+            shortened_doc['display_text'] = body['display_text']
             shortened_doc['link'] = doc['links'][0]
             
             # swap out image
@@ -95,6 +183,7 @@ class Articles(restful.Resource):
 
         self.parser.add_argument('user_id', type=str, help='user_id must be a valid user id')
         self.parser.add_argument('count', type=int, help='count must be an integer number')
+        self.parser.add_argument('fields', type=str, help='fields must be full or list')
 
     def get(self):
 
@@ -104,32 +193,123 @@ class Articles(restful.Resource):
         count = args['count']
         user_id = args['user_id']
 
+        if count is None:
+            count = algo.max_count
+
+        if args['fields'] not in [None, 'full', 'list']:
+            return make_error(404, 'fields must be full or list')
+
+        # user row and served filter are read concurrently, new candidates are loaded meanwhile
+        user_future = cassandra_client.find_user_async(user_id)
+        served_filter_future = cassandra_client.get_served_filter_async(user_id)
+        algo.candidate_index.refresh()
+
         try:
-            user_data = cassandra_client.find_user(user_id)
+            user_data = user_future.result()
         except IndexError as e:
             return make_error(404, 'user_id not found')
 
         article_algo = user_data[1]
 
-        if article_algo == 1:
-            server = algo.WeightedAverage(user_id)
-        else:
-            raise RuntimeError("unsupported article serving algorithm "+str(article_algo))
+        # answer from the page computed in the background when nothing changed since
+        articles = page_cache.take(user_id, count, database.user_dna(user_data), algo.candidate_index.version)
 
-        articles = server.serve(count)
+        if articles is None:
+            server = article_server(user_id, article_algo)
+            articles = server.serve(count, user_data, served_filter_future.result())
 
         if articles is None:
             log.warning('something went wrong, did not find articles')
             return make_error(500, 'article serving error')
-    
-        cassandra_client.add_served_articles(user_id, [art['article_id'] for art in articles])
+
+        # written behind the response, the served filter is already updated in memory
+        cassandra_client.record_served_articles(user_id, [art['article_id'] for art in articles])
+        # only after recording, a page computed meanwhile may hold the articles just served
+        page_cache.invalidate(user_id)
+        page_cache.schedule(user_id, count)
         end = time.time()
         log.info('request for articles completed in ' + str(end-start) +  ' s')
 
-        return flask.jsonify({'count': len(articles), 'articles': articles})
+        return articles_response(articles, args['fields'] == 'list')
     
 
 
+class ArticleBody(restful.Resource):
+    """
+    body of a single article, for clients that request the article list with fields=list
+    and only load the body when the article is opened
+    """
+
+    def get(self, article_id):
+
+        doc = bodies.find_one({'article_id': article_id}, {'_id': False, 'article_id': True, 'display_text': True})
+
+        if doc is None or doc.get('display_text') is None:
+            return make_error(404, 'article_id not found')
+
+        # bodies do not change once scraped, let clients and proxies cache them
+        response = flask.jsonify(doc)
+        response.cache_control.public = True
+        response.cache_control.max_age = article_body_max_age
+        response.add_etag()
+        return response.make_conditional(flask.request)
+
+
+class ArticlesBatch(restful.Resource):
+    """
+    serve articles to many users in one call, for push notification and digest jobs.
+    articles returned are recorded as served, same as GET articles
+    """
+
+    def post(self):
+
+        start = time.time()
+
+        if batch_api_key is None or not hmac.compare_digest(flask.request.headers.get('X-Noozli-Key', ''), batch_api_key):
+            return make_error(401, 'invalid api key')
+
+        if flask.request.headers['Content-Type'] != 'application/json':
+            return make_error(404, 'content-type must be application/json')
+
+        try:
+            data = json.loads(bytes.decode(flask.request.data))
+        except:
+            return make_error(404, 'posted data not in json format')
+
+        try:
+            count = int(data['count'])
+        except (KeyError, TypeError, ValueError):
+            return make_error(404, 'must provide a count')
+
+        try:
+            user_ids = data['user_ids']
+        except KeyError:
+            return make_error(404, 'required parameter user_ids missing')
+
+        if type(user_ids) != list or not all(type(user_id) == str for user_id in user_ids):
+            return make_error(404, 'user_ids must be a list of strings')
+
+        if len(user_ids) > max_batch_users:
+            return make_error(404, 'at most ' + str(max_batch_users) + ' user_ids per request')
+
+        results = algo.serve_batch(user_ids, count)
+
+        users = {}
+        for user_id, articles in results.items():
+            if articles is None:
+                continue
+
+            if len(articles) > 0:
+                cassandra_client.record_served_articles(user_id, [art['article_id'] for art in articles])
+                page_cache.invalidate(user_id)
+            users[user_id] = {'count': len(articles), 'articles': articles}
+
+        end = time.time()
+        log.info('batch request for articles for ' + str(len(user_ids)) + ' users completed in ' + str(end-start) + ' s')
+
+        return flask.jsonify({'count': len(users), 'users': users})
+
+
 class Users(restful.Resource):
     
     def get(self):
@@ -223,14 +403,19 @@ class Users(restful.Resource):
                 break
 
         analytics_strings = [ json.dumps(item) for item in analytics ]
-        cassandra_client.add_article_analytics(user_id, article_ids, analytics_strings, sources)
+        engagements = [ algo.engagement_mapping(item, 1) > 0 for item in analytics ]
+        cassandra_client.add_article_analytics(user_id, article_ids, analytics_strings, sources, engagements)
+
+        # counters of the other processes are picked up on the next engagement load
+        for article_id, positive in zip(article_ids, engagements):
+            algo.candidate_index.add_engagement(article_id, positive)
         end_time = time.time()
 
         log.info('post of analytics completed in ' + str(end_time-start_time) + 's.')
 
-        # launch learning procedure and return
-        pool = multiprocessing.Pool(processes=1)
-        r = pool.apply_async(algo.learn, [user_id, analytics, cassandra_client.get_article_algo(user_id)])
+        # queue learning procedure and return, learning needs to know which article each analytics belong to
+        article_algo = cassandra_client.get_article_algo(user_id)
+        learning.submit(user_id, [ dict(item, article_id=article_id) for item, article_id in zip(analytics, article_ids) ], article_algo)
 
         response = flask.jsonify({'status':  200, 'message': 'success'})
         response.status_code = 200
@@ -272,6 +457,8 @@ class Scraper(restful.Resource):
         return response
     
 api.add_resource(Articles, '/1.0/articles')
+api.add_resource(ArticlesBatch, '/1.0/articles/batch')
+api.add_resource(ArticleBody, '/1.0/articles/<string:article_id>')
 api.add_resource(Users, '/1.0/users')
 api.add_resource(Alive, '/1.0/alive')
 api.add_resource(ArticlesTest, '/test/articles')
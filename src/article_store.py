@@ -0,0 +1,226 @@
+"""
+article_store.py
+memory mapped store of article dna vectors shared by every process on the host
+
+the ingester (rss.parse_feed) appends new articles to three column files: a float32 dna
+matrix, float64 utc timestamps and a fixed width article_id table, all sorted by
+timestamp.  every append writes a new generation of the files and then atomically swaps
+the CURRENT file to point at it, so readers never see a partial write.
+
+api processes open the current generation read only with numpy memmaps, which means all
+of them share the same pages in the page cache and score straight from them.
+"""
+
+import datetime
+import fcntl
+import glob
+import logging
+import numpy as np
+import os
+
+import dna_vectors
+
+log = logging.getLogger('noozli_api')
+
+store_dir = '/home/ubuntu/noozli-server/store'
+
+# articles older than this are dropped when a new generation is written
+retention = datetime.timedelta(hours=144)
+
+id_dtype = np.dtype('S32')
+
+columns = ['ids', 'timestamps', 'dna']
+
+epoch = datetime.datetime(1970, 1, 1)
+
+
+def to_epoch(timestamp):
+    """
+    :param timestamp: datetime, naive datetimes are taken as utc
+    :returns: float, seconds since the epoch
+    """
+
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+    return (timestamp - epoch).total_seconds()
+
+
+class ArticleStore:
+
+    def __init__(self, path=store_dir):
+        """
+        :param path: string, directory holding the generation files
+        """
+
+        self.path = path
+
+        # (generation, ids, timestamps, dna) of the mapped generation, replaced with a single
+        # assignment so a reader always gets columns of the same generation
+        self.mapped = None
+        # (inode, mtime) of the CURRENT file, every swap renames a new file over it
+        self.current_stat = None
+
+    def column_path(self, column, generation):
+        return os.path.join(self.path, column + '.' + str(generation) + '.npy')
+
+    def current_generation(self):
+        try:
+            with open(os.path.join(self.path, 'CURRENT'), 'r') as current_f:
+                return int(current_f.read())
+        except (IOError, ValueError):
+            return None
+
+    #
+    # Reader
+    #
+
+    def open(self):
+        """
+        Map the current generation if it changed since the last call
+
+        :returns: bool, True if a generation is mapped
+        """
+
+        try:
+            stat = os.stat(os.path.join(self.path, 'CURRENT'))
+        except OSError:
+            return self.mapped is not None
+
+        current_stat = (stat.st_ino, stat.st_mtime)
+        if current_stat == self.current_stat:
+            return self.mapped is not None
+
+        generation = self.current_generation()
+        mapped = self.mapped
+        if generation is None or (mapped is not None and generation == mapped[0]):
+            self.current_stat = current_stat
+            return mapped is not None
+
+        try:
+            ids = np.load(self.column_path('ids', generation), mmap_mode='r')
+            timestamps = np.load(self.column_path('timestamps', generation), mmap_mode='r')
+            dna = np.load(self.column_path('dna', generation), mmap_mode='r')
+        except IOError as e:
+            log.warning('Failed to open article store generation ' + str(generation) + ': ' + str(e))
+            return self.mapped is not None
+
+        # decode the id table once per generation
+        self.mapped = (generation, [ article_id.decode() for article_id in ids ], timestamps, dna)
+        self.current_stat = current_stat
+
+        return True
+
+    def window(self, start, end):
+        """
+        Articles with start <= timestamp < end, oldest first
+
+        :param start: datetime, start of the window (inclusive)
+        :param end: datetime, end of the window (exclusive)
+        :returns: (list of article ids, timestamps array, dna matrix) views into the mapped
+                  generation, or None if no generation is available
+        """
+
+        if not self.open():
+            return None
+
+        # read once, another thread may map a newer generation meanwhile
+        generation, ids, timestamps, dna = self.mapped
+        lo, hi = np.searchsorted(timestamps, [to_epoch(start), to_epoch(end)])
+        return ids[lo:hi], timestamps[lo:hi], dna[lo:hi]
+
+    #
+    # Writer
+    #
+
+    def append(self, articles, now=None):
+        """
+        Write a new generation with the given articles added and expired ones dropped
+
+        :param articles: list of (article_id, timestamp datetime, dna vector) tuples
+        :param now: datetime, current utc time used for the retention cutoff
+        """
+
+        if len(articles) == 0:
+            return
+
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        with open(os.path.join(self.path, 'LOCK'), 'w') as lock_f:
+            # one writer at a time
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+
+            generation = self.current_generation()
+            if generation is None:
+                ids = np.zeros(0, dtype=id_dtype)
+                timestamps = np.zeros(0)
+                dna = np.zeros((0, dna_vectors.dna_length), dtype=dna_vectors.dna_dtype)
+                generation = 0
+            else:
+                ids = np.load(self.column_path('ids', generation))
+                timestamps = np.load(self.column_path('timestamps', generation))
+                dna = np.load(self.column_path('dna', generation))
+
+            # an article given twice is stored once, and one stored already is replaced, so
+            # appending what the store may partly hold (see rebuild) adds no duplicates
+            new_ids, first = np.unique(np.array([ article[0] for article in articles ], dtype=id_dtype), return_index=True)
+            # new_ids is sorted, an old id is replaced if it is found at its insertion point
+            found = np.minimum(np.searchsorted(new_ids, ids), len(new_ids) - 1)
+            keep = new_ids[found] != ids
+
+            ids = np.concatenate([ids[keep], new_ids])
+            timestamps = np.concatenate([timestamps[keep], np.array([ to_epoch(articles[i][1]) for i in first ])])
+            dna = np.vstack([dna[keep], np.array([ articles[i][2] for i in first ], dtype=dna_vectors.dna_dtype)])
+
+            order = np.argsort(timestamps, kind='mergesort')
+            order = order[timestamps[order] >= to_epoch(now - retention)]
+
+            generation += 1
+            for column, values in zip(columns, [ids[order], timestamps[order], dna[order]]):
+                self.write_atomic(self.column_path(column, generation), lambda f: np.save(f, values))
+
+            self.write_atomic(os.path.join(self.path, 'CURRENT'), lambda f: f.write(str.encode(str(generation))))
+
+            # readers may still map the previous generation, older ones can go
+            for column in columns:
+                for old_path in glob.glob(os.path.join(self.path, column + '.*.npy')):
+                    try:
+                        old_generation = int(old_path.rsplit('.', 2)[1])
+                    except ValueError:
+                        continue
+                    if old_generation < generation - 1:
+                        os.remove(old_path)
+
+            log.info('article store generation ' + str(generation) + ' holds ' + str(len(order)) + ' articles')
+
+    def rebuild(self, collection, now=None):
+        """
+        Append every servable article of the retention window in db.streaming, the ones the
+        store holds already are replaced.  Builds the first generation before the ingester appends to the store
+        and repairs it after an append failed.  Runs while the ingester keeps appending.
+
+        :param collection: mongo collection the article metadata is inserted into
+        :param now: datetime, current utc time used for the retention cutoff
+        :returns: int, articles read from collection
+        """
+
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        articles = []
+        for doc in collection.find({'timestamp': {'$gte': now - retention}, 'has_text': True}, {'article_id': True, 'timestamp': True, 'dna': True, 'topics': True}):
+            articles.append((doc['article_id'], doc['timestamp'], dna_vectors.article_dna(doc)))
+
+        self.append(articles, now=now)
+        return len(articles)
+
+    def write_atomic(self, path, write):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
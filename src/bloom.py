@@ -0,0 +1,196 @@
+"""
+bloom.py
+bloom filters used to check which articles were served to a user without reading
+noozli.users_served
+
+a bloom filter never reports a false negative, so an article that is not in the filter
+was definitely not served.  a possible hit still has to be confirmed against the table.
+
+filters are sized from the number of articles served to the user and rebuilt larger from
+the table once they fill up, see NoozliClient.save_served_filter.
+"""
+
+import hashlib
+import math
+import struct
+import threading
+
+default_size = 16384
+
+# bits per key for about 1% false positives with 7 hashes
+bits_per_key = 10
+
+
+def size_for(count):
+    """
+    :param count: int, number of keys the filter has to hold
+    :returns: int, smallest power of two bits, at least default_size, that holds twice count
+    """
+
+    size = default_size
+    while size < 2 * count * bits_per_key:
+        size *= 2
+    return size
+
+
+class BloomFilter:
+
+    def __init__(self, size=default_size, hashes=7, bits=None):
+        """
+        :param size: int, number of bits, multiple of 8
+        :param hashes: int, number of bit positions set per key
+        :param bits: bytes, existing filter contents to load, overrides size
+        """
+
+        self.hashes = hashes
+        if bits is None:
+            self.bits = bytearray(size // 8)
+        else:
+            self.bits = bytearray(bits)
+        self.size = len(self.bits) * 8
+        self.lock = threading.Lock()
+
+        # keys added, estimated from the set bits for a loaded filter
+        self.count = 0 if bits is None else self.estimated_count()
+
+    def estimated_count(self):
+        set_bits = bin(int.from_bytes(self.bits, 'big')).count('1')
+        if set_bits == self.size:
+            return self.size
+        return int(round(-self.size / self.hashes * math.log(1 - set_bits / self.size)))
+
+    def capacity(self):
+        """
+        :returns: int, keys the filter holds before false positives exceed about 1%
+        """
+
+        return self.size // bits_per_key
+
+    def positions(self, key):
+        # double hashing, two 64 bit halves of an md5 digest
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(str.encode(key)).digest())
+        return [ (h1 + i*h2) % self.size for i in range(self.hashes) ]
+
+    def add(self, key):
+        positions = self.positions(key)
+        with self.lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def merge(self, other):
+        """
+        Add the keys of another filter of the same size
+
+        :param other: BloomFilter
+        :returns: bool, False if the sizes differ and nothing was merged
+        """
+
+        if other.size != self.size:
+            return False
+
+        other_bits = int.from_bytes(other.to_bytes(), 'big')
+        with self.lock:
+            self.bits = bytearray((int.from_bytes(self.bits, 'big') | other_bits).to_bytes(len(self.bits), 'big'))
+            self.count = self.estimated_count()
+        return True
+
+    def __contains__(self, key):
+        for position in self.positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def to_bytes(self):
+        with self.lock:
+            return bytes(self.bits)
+
+
+class ServedFilter:
+    """
+    Two generational bloom filters that follow the users_served ttl.
+
+    Each generation covers one ttl period.  When a new period starts the current filter
+    becomes the previous one and the old previous filter is dropped, so a served article
+    stays in the filter for at least one full ttl and at most two.
+    """
+
+    def __init__(self, generation, current=None, previous=None, size=default_size):
+        """
+        :param generation: int, ttl period the current filter belongs to
+        :param current: bytes, contents of the current filter
+        :param previous: bytes, contents of the previous filter
+        :param size: int, number of bits of filters created empty
+        """
+
+        self.generation = generation
+        self.current = BloomFilter(size=size, bits=current)
+        self.previous = BloomFilter(size=size, bits=previous)
+        # held while the filters are replaced, so no article added meanwhile is lost
+        self.lock = threading.RLock()
+
+    def rotate(self, generation):
+        """
+        Move the filters forward to the given ttl period
+
+        :param generation: int, current ttl period
+        """
+
+        with self.lock:
+            if generation <= self.generation:
+                return
+
+            size = self.current.size
+            if generation == self.generation + 1:
+                self.previous = self.current
+            else:
+                self.previous = BloomFilter(size=size)
+            self.current = BloomFilter(size=size)
+            self.generation = generation
+
+    def add(self, article_id):
+        with self.lock:
+            self.current.add(article_id)
+
+    def full(self):
+        """
+        :returns: bool, True if the current filter holds more articles than its capacity
+        """
+
+        return self.current.count > self.current.capacity()
+
+    def merge(self, generation, current, previous):
+        """
+        Add the articles of a stored copy of the filter, e.g. saved by another process
+
+        :param generation: int, ttl period of the stored filter
+        :param current: bytes, stored current filter
+        :param previous: bytes, stored previous filter
+        :returns: bool, False if the filter sizes differ, the filter has to be rebuilt then
+        """
+
+        stored = ServedFilter(generation, current, previous)
+        with self.lock:
+            stored.rotate(self.generation)
+            self.rotate(stored.generation)
+            return self.current.merge(stored.current) and self.previous.merge(stored.previous)
+
+    def rebuild(self, article_ids, size=default_size):
+        """
+        Replace the filters with one holding the given articles
+
+        :param article_ids: set of strings, every article served within the ttl
+        :param size: int, minimum number of bits
+        """
+
+        size = max(size, size_for(len(article_ids)))
+        current = BloomFilter(size=size)
+        for article_id in article_ids:
+            current.add(article_id)
+
+        with self.lock:
+            self.current = current
+            self.previous = BloomFilter(size=size)
+
+    def __contains__(self, article_id):
+        return article_id in self.current or article_id in self.previous
@@ -0,0 +1,46 @@
+"""
+bodies.py
+article bodies are stored in db.bodies, apart from the article metadata in db.streaming
+
+db.streaming only keeps the small fields serving and learning read (article_id,
+timestamp, topics, dna, title, source, image, links, ...) so its working set stays in
+memory.  full_text, summary and display_text live in db.bodies keyed by article_id and
+are only read when an article is loaded into the candidate index or opened.
+"""
+
+import hashlib
+
+# fields moved from the article document to its body document
+body_fields = ['full_text', 'summary', 'display_text']
+
+
+def text_hash(full_text):
+    """
+    :param full_text: string, scraped text of an article
+    :returns: string, md5 hex digest used to find resyndicated copies of the same text
+    """
+
+    return hashlib.md5(str.encode(full_text)).hexdigest()
+
+
+def split_article(article_data):
+    """
+    Split an article document into its metadata and body documents
+
+    :param article_data: dict, full article document as built by rss.parse_feed
+    :returns: (metadata dict for db.streaming, body dict for db.bodies or None if no text was scraped)
+    """
+
+    has_text = article_data.get('full_text') is not None
+
+    metadata = {k: v for k, v in article_data.items() if k not in body_fields}
+    metadata['has_text'] = has_text
+
+    if not has_text:
+        return metadata, None
+
+    body = {k: article_data.get(k) for k in body_fields}
+    body['article_id'] = article_data['article_id']
+    body['text_hash'] = text_hash(article_data['full_text'])
+
+    return metadata, body
@@ -9,11 +9,21 @@ cassandra is currently storing:
 -  all source data (coming soon)
 """
 
+from cassandra import InvalidRequest
 from cassandra.cluster import Cluster
+from cassandra.query import BatchStatement, BatchType
+import atexit
+import bloom
+import collections
 import datetime
+import dna_vectors
+import engagement_ring
 import json
 import logger
 import logging
+import queue
+import threading
+import time
 import uuid
 
 log = logging.getLogger('noozli_api')
@@ -22,8 +32,215 @@ if not log.handlers:
 #    log.addHandler(logger.NoozliStreamingHandler())
     log.addHandler(logger.NoozliHandler('api.log'))
 
+# users_served rows expire after 30 days
+served_ttl = 2595600
+
+
+class QueryFuture:
+    """
+    result of one or more queries started with execute_async, converted the same way the
+    blocking accessor converts its results
+    """
+
+    def __init__(self, futures, convert):
+        """
+        futures:list<ResponseFuture> - queries in flight
+        convert:function - takes the list of query results, returns the accessor result
+        """
+
+        self.futures = futures
+        self.convert = convert
+
+    def result(self):
+        return self.convert([ future.result() for future in self.futures ])
+
+
+class ServedRecorder:
+    """
+    write-behind recorder for noozli.users_served
+
+    requests hand off (user_id, article_id) pairs and return immediately.  a background
+    thread groups queued pairs per user, i.e. per partition, and writes each group as one
+    unlogged batch of prepared inserts, retrying failed batches a bounded number of times.
+    pairs stay visible through pending() until they are written, so served checks made
+    in the meantime still see them.
+
+    the served filters of recorded users are saved by the same thread, once per user every
+    save_interval seconds instead of with every batch.  other processes find the articles
+    in their copy of the filter once it is saved, see NoozliClient.get_served_filter
+    """
+
+    def __init__(self, client, flush_interval=0.5, max_retries=3, save_interval=10):
+        """
+        client:NoozliClient - connected client, provides the session and prepared statements
+        flush_interval:float - seconds to collect pairs before writing them
+        max_retries:int - attempts per batch before its rows are dropped
+        save_interval:float - seconds a served filter with new articles waits before it is saved
+        """
+
+        self.client = client
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.save_interval = save_interval
+
+        self.queue = queue.Queue()
+        # set when pairs are queued, pairs stay in the queue until flushed so the flush at
+        # process exit sees all of them
+        self.queued = threading.Event()
+        self.pending_served = collections.defaultdict(set)
+        # user_id -> (time of the first unsaved article, filters to save), oldest first.  a
+        # user can have two filters if the cached one was dropped and loaded again meanwhile
+        self.unsaved_filters = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+        self.worker = None
+
+    def record(self, user_id, article_ids, served_filter=None):
+        """
+        queue articles sent to a user
+
+        user_id:string - string version of uuid for a user
+        article_ids:list<string> - articles sent to the user
+        served_filter:bloom.ServedFilter - filter the articles were added to, saved later
+        """
+
+        with self.lock:
+            self.pending_served[user_id].update(article_ids)
+            if served_filter is not None:
+                since, filters = self.unsaved_filters.setdefault(user_id, (time.time(), []))
+                if not any(served_filter is unsaved for unsaved in filters):
+                    filters.append(served_filter)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name='noozli-served-recorder')
+                self.worker.daemon = True
+                self.worker.start()
+
+        for article_id in article_ids:
+            self.queue.put((user_id, article_id))
+        self.queued.set()
+
+    def pending(self, user_id):
+        """
+        returns: set of article ids recorded for the user but not written yet
+        """
+
+        with self.lock:
+            return set(self.pending_served.get(user_id, ()))
+
+    def run(self):
+
+        while True:
+            if self.queued.wait(self.save_interval):
+                time.sleep(self.flush_interval)
+                # pairs queued after this are either drained by the flush or set the event again
+                self.queued.clear()
+                self.flush()
+            self.save_filters(self.save_interval)
+
+    def close(self):
+        """
+        write every queued pair and save every filter, registered to run at process exit
+        so mod_wsgi process recycling does not lose them
+        """
+
+        self.flush()
+        self.save_filters()
+
+    def flush(self):
+        """
+        write every queued pair
+        """
+
+        pairs = []
+
+        while True:
+            try:
+                pairs.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        groups = collections.OrderedDict()
+        for user_id, article_id in pairs:
+            groups.setdefault(user_id, []).append(article_id)
+
+        with self.write_lock:
+            for user_id, article_ids in groups.items():
+                self.write(user_id, article_ids)
+
+    def write(self, user_id, article_ids):
+
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for article_id in article_ids:
+            batch.add(self.client.served_insert_cql, (uuid.UUID(user_id), article_id))
+
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self.client.session.execute(batch)
+                break
+            except Exception as e:
+                log.warning('failed to record served articles for ' + user_id + ' (attempt ' + str(attempt) + '): ' + str(e))
+                time.sleep(0.1 * attempt)
+        else:
+            log.error('dropped ' + str(len(article_ids)) + ' served articles for ' + user_id)
+
+        with self.lock:
+            served = self.pending_served.get(user_id)
+            if served is not None:
+                served.difference_update(article_ids)
+                if len(served) == 0:
+                    del self.pending_served[user_id]
+
+    def save_filters(self, min_age=None):
+        """
+        save the served filters that have had new articles for at least min_age seconds
+
+        min_age:float - every unsaved filter is saved if None
+        """
+
+        now = time.time()
+        due = []
+        with self.lock:
+            while len(self.unsaved_filters) > 0:
+                user_id, (since, filters) = next(iter(self.unsaved_filters.items()))
+                if min_age is not None and now - since < min_age:
+                    break
+                self.unsaved_filters.popitem(last=False)
+                due.append((user_id, filters))
+
+        for user_id, filters in due:
+            for served_filter in filters:
+                try:
+                    self.client.save_served_filter(user_id, served_filter)
+                except Exception as e:
+                    log.warning('failed to save the served filter of ' + user_id + ': ' + str(e))
+
+
+def user_dna(user_data):
+    """
+    dna of a users row, from dna_blob or from the json dna text of rows not migrated yet
+    (see tools/cassandra_tools.py)
+
+    user_data:namedtuple - row with the dna, dna_blob and dna_version columns
+
+    returns: list<float>
+    """
+
+    if user_data.dna_blob is not None:
+        return dna_vectors.unpack_user_dna(user_data.dna_blob, user_data.dna_version)
+    return json.loads(user_data.dna)['dna']
+
+
 class NoozliClient:
     session = None
+    served_fetch_size = 1000
+    served_in_size = 100
+    served_filter_cache_size = 5000
+
+    def __init__(self):
+        # per user bloom filters of served article ids, least recently used first
+        self.served_filters = collections.OrderedDict()
+        self.served_filters_lock = threading.Lock()
 
     def connect(self, nodes):
         cluster = Cluster(nodes)
@@ -33,15 +250,46 @@ class NoozliClient:
         for host in metadata.all_hosts():
             log.info('Datacenter: %s; Host: %s; Rack: %s', host.datacenter, host.address, host.rack)
 
+        # the statements below use tables and columns added after the keyspace was created
+        if 'noozli' in metadata.keyspaces:
+            self.upgrade_schema()
+
         self.user_create_cql = self.session.prepare("""
-           INSERT INTO noozli.users (id, dna, article_serve_algo, dna_update_algo, danger_metric, danger_fix, engagement_mapping)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+           INSERT INTO noozli.users (id, dna_blob, dna_version, article_serve_algo, dna_update_algo, danger_metric, danger_fix, engagement_mapping, engagement_bits, engagement_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """)
 
         self.query_user_cql = self.session.prepare("SELECT * FROM noozli.users WHERE id = ?;")
-        self.query_dna_cql = self.session.prepare("SELECT dna FROM noozli.users WHERE id = ?;")
+        self.query_dna_cql = self.session.prepare("SELECT dna, dna_blob, dna_version FROM noozli.users WHERE id = ?;")
+        # the json text is cleared once the blob is written, it would be stale otherwise
+        self.update_dna_cql = self.session.prepare("UPDATE noozli.users SET dna_blob = ?, dna_version = ?, dna = null WHERE id = ?;")
+        self.query_engagement_cql = self.session.prepare("SELECT engagement_bits, engagement_count FROM noozli.users WHERE id = ?;")
+        # the ring buffer is only written if it did not change since it was read, see push_engagements
+        self.update_engagement_cql = self.session.prepare("""
+            UPDATE noozli.users SET engagement_bits = ?, engagement_count = ?
+            WHERE id = ? IF engagement_bits = ? AND engagement_count = ?
+        """)
         self.query_if_served_cql = self.session.prepare("SELECT * FROM noozli.users_served WHERE user_id = ? AND article_id = ?;")
+        self.query_served_cql = self.session.prepare("SELECT article_id FROM noozli.users_served WHERE user_id = ?;")
+        self.query_served_in_cql = self.session.prepare("SELECT article_id FROM noozli.users_served WHERE user_id = ? AND article_id IN ?;")
         self.query_article_algo_cql = self.session.prepare("SELECT article_serve_algo FROM noozli.users WHERE id = ?;")
+        self.query_served_filter_cql = self.session.prepare("SELECT generation, current, previous FROM noozli.users_served_filter WHERE user_id = ?;")
+        # filters are only written if the stored one did not change since it was read, see save_served_filter
+        self.insert_served_filter_cql = self.session.prepare("""
+            INSERT INTO noozli.users_served_filter (user_id, generation, current, previous)
+            VALUES (?, ?, ?, ?) IF NOT EXISTS
+        """)
+        self.update_served_filter_cql = self.session.prepare("""
+            UPDATE noozli.users_served_filter SET generation = ?, current = ?, previous = ?
+            WHERE user_id = ? IF current = ?
+        """)
+        self.served_insert_cql = self.session.prepare("INSERT INTO noozli.users_served (user_id, article_id) VALUES (?, ?) USING TTL " + str(served_ttl) + ";")
+        self.article_engagement_cql = self.session.prepare("UPDATE noozli.article_engagement SET positive = positive + ?, negative = negative + ? WHERE article_id = ?;")
+        self.source_engagement_cql = self.session.prepare("UPDATE noozli.source_engagement SET positive = positive + ?, negative = negative + ? WHERE source = ? AND month_year = ?;")
+        self.query_article_engagement_cql = self.session.prepare("SELECT article_id, positive, negative FROM noozli.article_engagement WHERE article_id IN ?;")
+
+        self.served_recorder = ServedRecorder(self)
+        atexit.register(self.served_recorder.close)
 
 
 
@@ -87,6 +335,7 @@ class NoozliClient:
             CREATE TABLE noozli.user_articles_ordered (
                user_id uuid,
                event_time timeuuid,
+               article_id text,
                analytics text,
                PRIMARY KEY (user_id, event_time))
              WITH CLUSTERING ORDER BY (event_time DESC);
@@ -129,8 +378,77 @@ class NoozliClient:
         # sources table
         # user-sources table
 
+        self.upgrade_schema()
+
         log.info('Noozli keyspace and schema created.')
 
+    def upgrade_schema(self):
+        """
+        Add tables and columns introduced after the keyspace was first created.  run by
+        connect before the statements using them are prepared, only what is missing is
+        created so api processes starting together do not all run schema changes
+        """
+
+        tables = self.session.cluster.metadata.keyspaces['noozli'].tables
+        upgraded = False
+
+        new_tables = [
+            ('users_served_filter', """
+                CREATE TABLE IF NOT EXISTS noozli.users_served_filter (
+                    user_id uuid PRIMARY KEY,
+                    generation int,
+                    current blob,
+                    previous blob
+                );
+            """),
+            # positive and negative engagement counts, updated with every analytics post
+            ('article_engagement', """
+                CREATE TABLE IF NOT EXISTS noozli.article_engagement (
+                    article_id text PRIMARY KEY,
+                    positive counter,
+                    negative counter
+                );
+            """),
+            ('source_engagement', """
+                CREATE TABLE IF NOT EXISTS noozli.source_engagement (
+                    source text,
+                    month_year text,
+                    positive counter,
+                    negative counter,
+                    PRIMARY KEY (source, month_year)
+                );
+            """),
+        ]
+
+        for table, cql in new_tables:
+            if table not in tables:
+                self.session.execute(cql)
+                upgraded = True
+
+        new_columns = [
+            # ring buffer of the most recent engagements of each user, see engagement_ring
+            ('users', 'engagement_bits', 'blob'),
+            ('users', 'engagement_count', 'int'),
+            # packed dna, see dna_vectors.pack_user_dna, replaces the json dna text
+            ('users', 'dna_blob', 'blob'),
+            ('users', 'dna_version', 'int'),
+            # article of each engagement, needed to replay the history (tools/replay_dna.py)
+            ('user_articles_ordered', 'article_id', 'text'),
+        ]
+
+        for table, column, column_type in new_columns:
+            if column in tables[table].columns:
+                continue
+            try:
+                self.session.execute("ALTER TABLE noozli." + table + " ADD " + column + " " + column_type + ";")
+                upgraded = True
+            except InvalidRequest:
+                # added by another process meanwhile
+                pass
+
+        if upgraded:
+            log.info('Noozli schema upgraded.')
+
     def delete_keyspace(self, name):
 
         ### this does not work for some reason
@@ -156,17 +474,168 @@ class NoozliClient:
         else:
             return False
 
+    def get_served_articles(self, user_id, article_ids=None):
+        """
+        find which articles were already sent to a user with a single paged query instead of
+        one check_if_served call per article
+
+        user_id:string - string version of uuid for a user
+        article_ids:list<string> - optional candidate article ids, when given only these clustering keys are read
+        returns: set of served article ids
+        """
+
+        return self.get_served_articles_async(user_id, article_ids).result()
+
+    def get_served_articles_async(self, user_id, article_ids=None):
+        """
+        same as get_served_articles, returns a future whose result() is the set
+        """
+
+        if article_ids is None:
+            statements = [self.query_served_cql.bind((uuid.UUID(user_id),))]
+        else:
+            # keep IN lists small, the coordinator fans out one read per value
+            article_ids = list(article_ids)
+            statements = []
+            for i in range(0, len(article_ids), self.served_in_size):
+                statements.append(self.query_served_in_cql.bind((uuid.UUID(user_id), article_ids[i:i+self.served_in_size])))
+
+        futures = []
+        for statement in statements:
+            statement.fetch_size = self.served_fetch_size
+            futures.append(self.session.execute_async(statement))
+
+        def convert(results_list):
+            served = set()
+            for results in results_list:
+                for row in results:
+                    served.add(row.article_id)
+            return served
+
+        return QueryFuture(futures, convert)
+
+    def get_served_filter(self, user_id):
+        """
+        bloom filter of the articles served to a user.  the copy in process memory is merged
+        with the persisted blob on every read, so articles another process served and saved
+        are found.  the filter is rebuilt from users_served when neither exists
+
+        user_id:string - string version of uuid for a user
+        returns: bloom.ServedFilter rotated to the current ttl period
+        """
+
+        return self.get_served_filter_async(user_id).result()
+
+    def get_served_filter_async(self, user_id):
+        """
+        same as get_served_filter, returns a future whose result() is the filter
+        """
+
+        generation = int(time.time() // served_ttl)
+
+        def convert(results_list):
+            results = results_list[0]
+
+            with self.served_filters_lock:
+                served_filter = self.served_filters.get(user_id)
+
+            if served_filter is None:
+                if len(results) > 0:
+                    served_filter = bloom.ServedFilter(results[0].generation, results[0].current, results[0].previous)
+                else:
+                    served_filter = bloom.ServedFilter(generation)
+                    self.rebuild_served_filter(user_id, served_filter)
+                    self.save_served_filter(user_id, served_filter)
+
+                with self.served_filters_lock:
+                    # another thread may have loaded it in the meantime, keep the first one
+                    served_filter = self.served_filters.setdefault(user_id, served_filter)
+
+            if len(results) > 0 and not served_filter.merge(results[0].generation, results[0].current, results[0].previous):
+                # another process grew the stored filter
+                self.rebuild_served_filter(user_id, served_filter, len(results[0].current) * 8)
+                served_filter.merge(results[0].generation, results[0].current, results[0].previous)
+
+            served_filter.rotate(generation)
+
+            with self.served_filters_lock:
+                if user_id in self.served_filters:
+                    self.served_filters.move_to_end(user_id)
+                while len(self.served_filters) > self.served_filter_cache_size:
+                    self.served_filters.popitem(last=False)
+
+            return served_filter
+
+        return QueryFuture([self.session.execute_async(self.query_served_filter_cql.bind((uuid.UUID(user_id),)))], convert)
+
+    def filter_served(self, user_id, article_ids, served_filter=None):
+        """
+        find which of the candidate articles were already sent to a user.  only articles the
+        bloom filter reports as possibly served are checked against users_served
+
+        user_id:string - string version of uuid for a user
+        article_ids:list<string> - candidate article ids
+        served_filter:bloom.ServedFilter - filter of the user if already loaded, e.g. with get_served_filter_async
+        returns: set of served article ids
+        """
+
+        return self.filter_served_async(user_id, article_ids, served_filter).result()
+
+    def filter_served_async(self, user_id, article_ids, served_filter=None):
+        """
+        same as filter_served, returns a future whose result() is the set
+        """
+
+        if served_filter is None:
+            served_filter = self.get_served_filter(user_id)
+
+        possible = [ article_id for article_id in article_ids if article_id in served_filter ]
+
+        # rows still queued in the recorder are not in users_served yet
+        served = self.served_recorder.pending(user_id).intersection(possible)
+        future = self.get_served_articles_async(user_id, [ article_id for article_id in possible if article_id not in served ])
+        return QueryFuture([future], lambda results_list: served | results_list[0])
+
+    def get_article_engagement(self, article_ids):
+        """
+        read the engagement counters of articles
+
+        article_ids:list<string> - articles to read the counters of
+        returns: dict article_id -> (positive, negative), articles without engagement are left out
+        """
+
+        futures = []
+        for i in range(0, len(article_ids), self.served_in_size):
+            futures.append(self.session.execute_async(self.query_article_engagement_cql.bind((article_ids[i:i+self.served_in_size],))))
+
+        counts = {}
+        for future in futures:
+            for row in future.result():
+                counts[row[0]] = (row[1] or 0, row[2] or 0)
+        return counts
+
     def get_dna(self, user_id):
         results = self.session.execute(self.query_dna_cql.bind((uuid.UUID(user_id),)))
         if len(results) > 1:
             log.warning('more than one row with id: ' + user_id)
-        return json.loads(results[0].dna)['dna']
+        return user_dna(results[0])
 
     def find_user(self, user_id):
-        results = self.session.execute(self.query_user_cql.bind((uuid.UUID(user_id),)))
-        if len(results) > 1:
-            log.warning('more than one row with id: ' + user_id)
-        return results[0]
+        return self.find_user_async(user_id).result()
+
+    def find_user_async(self, user_id):
+        """
+        same as find_user, returns a future whose result() is the user row and raises
+        IndexError if the user does not exist
+        """
+
+        def convert(results_list):
+            results = results_list[0]
+            if len(results) > 1:
+                log.warning('more than one row with id: ' + user_id)
+            return results[0]
+
+        return QueryFuture([self.session.execute_async(self.query_user_cql.bind((uuid.UUID(user_id),)))], convert)
 
     def get_article_algo(self, user_id):
         results = self.session.execute(self.query_article_algo_cql.bind((uuid.UUID(user_id),)))
@@ -193,33 +662,141 @@ class NoozliClient:
         for i in range(20):
             dna.append(float(0.5))
 
-        dna_string = '{"dna": ' + str(dna) + '}'
+        dna_blob, dna_version = dna_vectors.pack_user_dna(dna)
+
+        engagement_bits, engagement_count = engagement_ring.empty()
 
         self.session.execute(self.user_create_cql.bind((
                     uuid.UUID(user_id),
-                    dna_string,
+                    dna_blob, dna_version,
                     1, 1, 1, 1, 1,
+                    engagement_bits, engagement_count,
                     ))
         )
 
-    def add_served_articles(self, user_id, article_ids):
+    def set_dna(self, user_id, dna):
         """
-        add articles sent to a client to the database to prevent serving the same article more than once
-        
-        user_id:uuid - user that was sent articles
-        article_ids:list[str] - list of article ids to add to the user database for user with user_id
+        store the dna of a user
+
+        user_id:string - string version of uuid for a user
+        dna:list<float> - new dna of the user
         """
-        
-        cql_command = "BEGIN BATCH\n"
-        for i in range(len(article_ids)):
-            cql_command += "INSERT INTO noozli.users_served (user_id, article_id) VALUES (" + user_id + ", '" + article_ids[i] + "') USING TTL 2595600\n"
-        cql_command += "APPLY BATCH;"
 
-        self.session.execute(cql_command)
-        return True
+        dna_blob, dna_version = dna_vectors.pack_user_dna(dna)
+        self.session.execute(self.update_dna_cql.bind((dna_blob, dna_version, uuid.UUID(user_id))))
+
+    def set_engagements(self, user_id, engagement_bits, engagement_count, previous_bits, previous_count):
+        """
+        write the engagement ring buffer of a user if it still holds what was read
+
+        user_id:string - string version of uuid for a user
+        engagement_bits:bytes - new buffer, see engagement_ring
+        engagement_count:int - engagements recorded in the new buffer
+        previous_bits:bytes - buffer read before, None for users without one
+        previous_count:int - count read before
+        returns: bool, False if the buffer changed since it was read
+        """
+
+        result = self.session.execute(self.update_engagement_cql.bind((engagement_bits, engagement_count, uuid.UUID(user_id), previous_bits, previous_count)))
+        return result[0][0]
+
+    def push_engagements(self, user_id, positives, max_attempts=3):
+        """
+        add engagements to the ring buffer on the users row.  concurrent posts of a user,
+        also to other processes, each retry on the buffer the other wrote, so none is lost.
+        users created before the buffer are left alone until learn seeds it from their
+        history, which includes these engagements
+
+        user_id:string - string version of uuid for a user
+        positives:list<bool> - new engagements oldest first, True for positive
+        max_attempts:int - pushes tried while the buffer keeps changing
+        returns: bool, False if the buffer was not written
+        """
+
+        for attempt in range(max_attempts):
+            rows = self.session.execute(self.query_engagement_cql.bind((uuid.UUID(user_id),)))
+            if len(rows) == 0 or rows[0].engagement_bits is None:
+                return False
+
+            engagement_bits, engagement_count = engagement_ring.push(rows[0].engagement_bits, rows[0].engagement_count or 0, positives)
+            if self.set_engagements(user_id, engagement_bits, engagement_count, rows[0].engagement_bits, rows[0].engagement_count):
+                return True
 
+        log.warning('engagements of ' + user_id + ' not recorded, the ring buffer kept changing')
+        return False
 
-    def add_article_analytics(self, user_id, article_ids, analytics_strings, sources):
+    def rebuild_served_filter(self, user_id, served_filter, size=bloom.default_size):
+        """
+        refill the filter of a user from users_served, sized for the number of articles served
+
+        user_id:string - string version of uuid for a user
+        served_filter:bloom.ServedFilter - filter to refill
+        size:int - minimum number of bits
+        """
+
+        # articles added while users_served is read wait for the rebuilt filter
+        with served_filter.lock:
+            article_ids = self.get_served_articles(user_id) | self.served_recorder.pending(user_id)
+            served_filter.rebuild(article_ids, size)
+
+    def save_served_filter(self, user_id, served_filter, max_attempts=3):
+        """
+        write the filter of a user merged with the stored one.  every api process keeps its
+        own copy of the filter, the stored filter is or-ed in before writing so articles
+        added by another process are kept, and the write only applies if the stored filter
+        did not change since it was read.  a full filter, or one whose size differs from
+        the stored one because another process grew it, is rebuilt from users_served
+
+        user_id:string - string version of uuid for a user
+        served_filter:bloom.ServedFilter - filter to write, updated with the stored articles
+        max_attempts:int - merges tried while the stored filter keeps changing
+        returns: bool, False if the filter was not written
+        """
+
+        if served_filter.full():
+            self.rebuild_served_filter(user_id, served_filter)
+
+        for attempt in range(max_attempts):
+            rows = self.session.execute(self.query_served_filter_cql.bind((uuid.UUID(user_id),)))
+            if len(rows) > 0 and not served_filter.merge(rows[0].generation, rows[0].current, rows[0].previous):
+                self.rebuild_served_filter(user_id, served_filter, len(rows[0].current) * 8)
+                served_filter.merge(rows[0].generation, rows[0].current, rows[0].previous)
+
+            with served_filter.lock:
+                values = (served_filter.generation, served_filter.current.to_bytes(), served_filter.previous.to_bytes())
+
+            if len(rows) == 0:
+                result = self.session.execute(self.insert_served_filter_cql.bind((uuid.UUID(user_id),) + values))
+            else:
+                result = self.session.execute(self.update_served_filter_cql.bind(values + (uuid.UUID(user_id), rows[0].current)))
+
+            if result[0][0]:
+                return True
+
+        log.warning('served filter of ' + user_id + ' not saved, the stored filter kept changing')
+        return False
+
+    def record_served_articles(self, user_id, article_ids):
+        """
+        hand articles sent to a client to the write-behind recorder, returns without any
+        database round trip.  the served filter in process memory is updated right away
+
+        user_id:string - string version of uuid for a user
+        article_ids:list<string> - articles sent to the user
+        """
+
+        # serving loaded the filter, it is only read again if it was dropped from the cache since
+        with self.served_filters_lock:
+            served_filter = self.served_filters.get(user_id)
+        if served_filter is None:
+            served_filter = self.get_served_filter(user_id)
+
+        for article_id in article_ids:
+            served_filter.add(article_id)
+
+        self.served_recorder.record(user_id, article_ids, served_filter)
+
+    def add_article_analytics(self, user_id, article_ids, analytics_strings, sources, engagements=None):
         """
         store analytics for each article for a user
         
@@ -227,6 +804,9 @@ class NoozliClient:
         article_ids:list<string> - list of strings of article ids
         analytics_strings:list<string> - list of strings representations of json containing all analytics data
         sources:list<string> - list of the sources for each article
+        engagements:list<bool> - True for a positive engagement with each article, updates the
+                                 article and source engagement counters and the user's
+                                 engagement ring buffer if given
         """
 
         month_year_str = datetime.datetime.utcnow().strftime("%Y-%m")
@@ -235,8 +815,28 @@ class NoozliClient:
             cql_command += "INSERT INTO noozli.user_articles (user_id, article_id, analytics) VALUES (" + user_id + ", '" + article_ids[i] + "', '" + analytics_strings[i]  + "')\n" 
             cql_command += "INSERT INTO noozli.articles (article_id, event_time, analytics) VALUES ('" + article_ids[i] + "', now(), '" + analytics_strings[i]  + "')\n" 
             cql_command += "INSERT INTO noozli.sources (month_year, source, event_time, analytics) VALUES ('" + month_year_str + "', '" + sources[i] + "', now(), '" + analytics_strings[i]  + "')\n" 
-            cql_command += "INSERT INTO noozli.user_articles_ordered (user_id, event_time, analytics) VALUES (" + user_id + ", now(), '" + analytics_strings[i] + "')\n"
+            cql_command += "INSERT INTO noozli.user_articles_ordered (user_id, event_time, article_id, analytics) VALUES (" + user_id + ", now(), '" + article_ids[i] + "', '" + analytics_strings[i] + "')\n"
         cql_command += "APPLY BATCH;"
 
-        self.session.execute(cql_command)
+        futures = [self.session.execute_async(cql_command)]
+
+        if engagements is not None:
+            # counters can only be batched with counters
+            counter_batch = BatchStatement(batch_type=BatchType.COUNTER)
+            for i in range(len(article_ids)):
+                positive, negative = (1, 0) if engagements[i] else (0, 1)
+                counter_batch.add(self.article_engagement_cql, (positive, negative, article_ids[i]))
+                counter_batch.add(self.source_engagement_cql, (positive, negative, sources[i], month_year_str))
+            futures.append(self.session.execute_async(counter_batch))
+
+        for future in futures:
+            future.result()
+
+        if engagements is not None:
+            # pushed here rather than by learn, a dropped or failed dna update keeps them
+            try:
+                self.push_engagements(user_id, engagements)
+            except Exception as e:
+                log.warning('failed to record engagements of ' + user_id + ': ' + str(e))
+
         return True
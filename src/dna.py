@@ -1,8 +1,8 @@
-import json
 import pymongo
 import time
 
 import database
+import dna_vectors
 import logging
 
 log = logging.getLogger('noozli_api')
@@ -12,28 +12,7 @@ if not log.handlers:
     log.addHandler(logger.NoozliStreamingHandler())
 
 
-topic_to_index = {
-    'Arts': 0,
-    'Belief': 1,
-    'Business': 2,
-    'Culture': 3,
-    'Education': 4,
-    'Environment': 5,
-    'Health': 6,
-    'History': 7,     
-    'Language': 8,
-    'Law': 9,
-    'Leisure': 10,
-    'Mathematics': 11,
-    'Nature': 12,
-    'People': 13,
-    'Politics': 14,
-    'Science': 15,
-    'Sports': 16,
-    'Technology': 17,
-    'Violence': 18,
-    'Weather': 19
-    }
+topic_to_index = dna_vectors.topic_to_index
 
 try:
     cassandra_client = database.NoozliClient()
@@ -61,10 +40,7 @@ def article_to_dna_mapping(topics):
     :returns: list of floats in same order as user dna (alphabetical by topic name)
     """
     
-    article_dna = [float(0) for i in range(20)]
-    for topic in topics:
-        article_dna[topic_to_index[topic[0]]] = float(topic[1])
-    return article_dna
+    return dna_vectors.topics_to_dna(topics).tolist()
         
 
 def engagement_mapping(article_analytics, algo):
@@ -150,10 +126,10 @@ def update(user_id, analytics):
         coeff = engagement_mapping(data, user_data.engagement_mapping)
         log.info('mapping coeff:  ' + str(coeff))
         article = collection.find_one({'article_id': data['article_id']})
-        article_dna = article_to_dna_mapping(article['topics']['text_razor'])
+        article_dna = dna_vectors.article_dna(article).tolist()
         log.info('article_dna:  ' + str(article_dna))
 
-        user_dna = json.loads(user_data.dna)['dna']
+        user_dna = database.user_dna(user_data)
         log.info('user_dna:  ' + str(user_dna))
         updated_dna = update_dna(user_dna, article_dna, coeff, user_data.dna_update_algo)
         log.info('updated:  ' + str(updated_dna))
@@ -0,0 +1,122 @@
+"""
+dna_vectors.py
+article dna vectors packed as float32 bytes
+
+rss.parse_feed computes the dna of an article once when it is inserted and stores it in
+the 'dna' field, so serving and learning read the vector directly instead of mapping the
+text_razor topics on every request.
+
+user dna is packed the same way in the dna_blob column of noozli.users, with a dna_version
+that says how many values the blob holds.
+"""
+
+import numpy as np
+
+dna_dtype = np.dtype('<f4')
+
+dna_length = 20
+
+# number of values in a packed user dna by dna_version, new dna_update_algo variants that
+# change the dimensions add a version
+user_dna_lengths = {1: dna_length}
+
+user_dna_version = 1
+
+topic_to_index = {
+    'Arts': 0,
+    'Belief': 1,
+    'Business': 2,
+    'Culture': 3,
+    'Education': 4,
+    'Environment': 5,
+    'Health': 6,
+    'History': 7,
+    'Language': 8,
+    'Law': 9,
+    'Leisure': 10,
+    'Mathematics': 11,
+    'Nature': 12,
+    'People': 13,
+    'Politics': 14,
+    'Science': 15,
+    'Sports': 16,
+    'Technology': 17,
+    'Violence': 18,
+    'Weather': 19
+    }
+
+
+def topics_to_dna(topics):
+    """
+    Take topics stored with article and convert to dna vector
+
+    :param topics: list of lists, each sublist has [string: Topic Name, float: score], or None
+    :returns: numpy float32 array in same order as user dna (alphabetical by topic name)
+    """
+
+    dna = np.zeros(dna_length, dtype=dna_dtype)
+    if topics is not None:
+        for topic in topics:
+            dna[topic_to_index[topic[0]]] = float(topic[1])
+    return dna
+
+
+def pack(dna):
+    """
+    :param dna: list or array of floats
+    :returns: bytes, little endian float32 values
+    """
+
+    return np.asarray(dna, dtype=dna_dtype).tobytes()
+
+
+def unpack(packed):
+    """
+    :param packed: bytes from pack
+    :returns: read only numpy float32 array backed by packed
+    """
+
+    return np.frombuffer(packed, dtype=dna_dtype)
+
+
+def article_dna(art):
+    """
+    Dna vector of a stored article.  Uses the packed 'dna' field and falls back to the
+    topics for documents that were not backfilled yet.
+
+    :param art: dict, article document with 'dna' and / or 'topics' fields
+    :returns: numpy float32 array
+    """
+
+    packed = art.get('dna')
+    if packed is not None:
+        return unpack(packed)
+
+    try:
+        return topics_to_dna(art['topics']['text_razor'])
+    except KeyError:
+        return np.zeros(dna_length, dtype=dna_dtype)
+
+
+def pack_user_dna(dna):
+    """
+    :param dna: list of floats, user dna
+    :returns: (bytes, int) packed dna and its dna_version
+    """
+
+    if len(dna) != user_dna_lengths[user_dna_version]:
+        raise ValueError('dna holds ' + str(len(dna)) + ' values, version ' + str(user_dna_version) + ' expects ' + str(user_dna_lengths[user_dna_version]))
+    return pack(dna), user_dna_version
+
+
+def unpack_user_dna(packed, version):
+    """
+    :param packed: bytes from pack_user_dna
+    :param version: int, dna_version stored with the blob
+    :returns: list of floats
+    """
+
+    dna = unpack(packed)
+    if len(dna) != user_dna_lengths[version]:
+        raise ValueError('dna blob holds ' + str(len(dna)) + ' values, version ' + str(version) + ' expects ' + str(user_dna_lengths[version]))
+    return dna.tolist()
@@ -0,0 +1,65 @@
+"""
+engagement_ring.py
+ring buffer of a user's most recent engagements, one bit each, stored on the users row
+
+bit 0 is the most recent engagement, set for a positive engagement (engagement_mapping > 0)
+and clear for a negative one.  a new engagement shifts the older ones up by one bit and
+the oldest falls off after ring_size.  together with the number of engagements recorded
+it gives the success rates learn needs without reading the analytics history.
+"""
+
+ring_size = 128
+
+ring_bytes = ring_size // 8
+
+ring_mask = (1 << ring_size) - 1
+
+
+def empty():
+    """
+    :returns: (bytes, int) buffer and count of a user without engagements
+    """
+
+    return bytes(ring_bytes), 0
+
+
+def push(bits, count, positives):
+    """
+    Add engagements to a buffer
+
+    :param bits: bytes, current buffer
+    :param count: int, engagements recorded so far
+    :param positives: list of bools, new engagements oldest first, True for positive
+    :returns: (bytes, int) updated buffer and count
+    """
+
+    value = int.from_bytes(bits, 'big')
+    for positive in positives:
+        value = ((value << 1) | int(positive)) & ring_mask
+    return value.to_bytes(ring_bytes, 'big'), min(count + len(positives), ring_size)
+
+
+def from_history(positives):
+    """
+    Build a buffer from stored analytics
+
+    :param positives: list of bools, most recent engagement first, True for positive
+    :returns: (bytes, int) buffer and count
+    """
+
+    bits, count = empty()
+    return push(bits, count, list(reversed(positives[:ring_size])))
+
+
+def success_rate(bits, count, n):
+    """
+    :param bits: bytes, buffer
+    :param count: int, engagements recorded
+    :param n: int, number of most recent engagements to look at, at most ring_size
+    :returns: float, share of positive engagements among the last min(n, count), None if there are none
+    """
+
+    n = min(n, count)
+    if n == 0:
+        return None
+    return bin(int.from_bytes(bits, 'big') & ((1 << n) - 1)).count('1') / n
@@ -0,0 +1,104 @@
+"""
+learner.py
+long lived workers that update user dna after analytics are posted
+
+Users.post used to fork a new multiprocessing.Pool for every post.  jobs are now queued to
+a fixed number of worker threads started once per process.  all jobs of a user go to the
+same worker, so the dna updates of a user never run concurrently and are applied in the
+order they were posted.  queues are bounded: when a worker falls behind new jobs are
+dropped instead of piling up.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger('noozli_api')
+
+
+class Learner:
+
+    def __init__(self, learn, done=None, workers=2, max_queued=1000):
+        """
+        :param learn: function(user_id, analytics, algo) updating the dna of a user
+        :param done: function(user_id) called after the dna of a user was updated
+        :param workers: int, number of jobs run concurrently
+        :param max_queued: int, pending jobs over all workers, further jobs are dropped
+        """
+
+        self.learn = learn
+        self.done = done
+
+        self.queues = [ queue.Queue(maxsize=max(1, max_queued // workers)) for i in range(workers) ]
+        self.workers = []
+        for i, jobs in enumerate(self.queues):
+            worker = threading.Thread(target=self.run, args=(jobs,), name='noozli-learner-' + str(i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        self.stopped = False
+        atexit.register(self.shutdown)
+
+    def submit(self, user_id, analytics, algo):
+        """
+        Queue a dna update
+
+        :param user_id: string, uuid of the user
+        :param analytics: list of dicts, analytics of the posted articles
+        :param algo: int, article serve algorithm of the user
+        :returns: bool, False if the job was dropped
+        """
+
+        if self.stopped:
+            return False
+
+        try:
+            self.queues[hash(user_id) % len(self.queues)].put_nowait((user_id, analytics, algo))
+        except queue.Full:
+            log.warning('learning queue full, not updating dna for ' + user_id)
+            return False
+        return True
+
+    def run(self, jobs):
+
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+
+            user_id, analytics, algo = job
+            try:
+                self.learn(user_id, analytics, algo)
+            except Exception as e:
+                log.warning('learning failed for ' + user_id + ': ' + str(e))
+                continue
+
+            if self.done is not None:
+                try:
+                    self.done(user_id)
+                except Exception as e:
+                    log.warning('learning callback failed for ' + user_id + ': ' + str(e))
+
+    def shutdown(self, timeout=10):
+        """
+        Stop accepting jobs and finish the queued ones, waiting at most timeout seconds
+
+        :param timeout: float, seconds
+        """
+
+        if self.stopped:
+            return
+        self.stopped = True
+
+        deadline = time.time() + timeout
+        for jobs in self.queues:
+            try:
+                jobs.put(None, timeout=max(0, deadline - time.time()))
+            except queue.Full:
+                pass
+
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.time()))
@@ -0,0 +1,133 @@
+"""
+prefetch.py
+background computation of each active user's next page of articles
+
+after a user is served, or their dna changes, a worker thread computes the page they
+will get on their next request and keeps it in memory.  the articles endpoint answers
+from that page when it is still valid and falls back to computing it live otherwise.
+"""
+
+import collections
+import logging
+import queue
+import threading
+
+log = logging.getLogger('noozli_api')
+
+Page = collections.namedtuple('Page', ['articles', 'count', 'dna', 'version'])
+
+
+class PageCache:
+
+    def __init__(self, compute, max_users=10000, max_queued=1000, default_count=10):
+        """
+        :param compute: function(user_id, count) returning (articles, user dna, candidate version)
+        :param max_users: int, pages kept, least recently computed are dropped first
+        :param max_queued: int, pending computations, further requests are dropped
+        :param default_count: int, page size for users whose last request count is unknown
+        """
+
+        self.compute = compute
+        self.max_users = max_users
+        self.default_count = default_count
+
+        self.pages = collections.OrderedDict()
+        # last requested count per user, least recently requested are dropped first
+        self.counts = collections.OrderedDict()
+        # generation of each user whose page is being computed, bumped when the user's served
+        # set changes meanwhile so the page computed against the old set is discarded
+        self.generations = {}
+        self.lock = threading.Lock()
+
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.pending = set()
+
+        self.worker = threading.Thread(target=self.run, name='noozli-prefetch')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def schedule(self, user_id, count=None):
+        """
+        Queue computation of the next page for a user
+
+        :param user_id: string, uuid of the user
+        :param count: int, number of articles the page should hold, defaults to the last count requested
+        """
+
+        with self.lock:
+            if count is None:
+                count = self.counts.get(user_id, self.default_count)
+            else:
+                self.counts[user_id] = count
+                self.counts.move_to_end(user_id)
+                while len(self.counts) > self.max_users:
+                    self.counts.popitem(last=False)
+
+            if user_id in self.pending:
+                return
+            try:
+                self.queue.put_nowait((user_id, count))
+            except queue.Full:
+                log.warning('prefetch queue full, not precomputing articles for ' + user_id)
+                return
+            self.pending.add(user_id)
+
+    def take(self, user_id, count, dna, version):
+        """
+        Remove and return the precomputed page of a user if it is still valid
+
+        :param user_id: string, uuid of the user
+        :param count: int, requested number of articles
+        :param dna: current dna of the user, the page is discarded if it was computed for another one
+        :param version: int, current candidate index version, the page is discarded if new articles arrived
+        :returns: list of article dicts or None
+        """
+
+        with self.lock:
+            page = self.pages.pop(user_id, None)
+
+            if page is None:
+                return None
+
+            if page.dna != dna or page.version != version or page.count < count:
+                return None
+
+        return page.articles[:count]
+
+    def invalidate(self, user_id):
+        """
+        Drop the page of a user and discard the one being computed.  call after articles
+        served to the user were recorded, a computation that started earlier read the old
+        served set and may contain them
+
+        :param user_id: string, uuid of the user
+        """
+
+        with self.lock:
+            self.pages.pop(user_id, None)
+            if user_id in self.generations:
+                self.generations[user_id] += 1
+
+    def run(self):
+
+        while True:
+            user_id, count = self.queue.get()
+
+            with self.lock:
+                self.pending.discard(user_id)
+                generation = self.generations.setdefault(user_id, 0)
+
+            try:
+                articles, dna, version = self.compute(user_id, count)
+            except Exception as e:
+                log.warning('prefetch failed for ' + user_id + ': ' + str(e))
+                articles = None
+
+            with self.lock:
+                if self.generations.pop(user_id) != generation or articles is None:
+                    continue
+
+                self.pages[user_id] = Page(articles, count, dna, version)
+                self.pages.move_to_end(user_id)
+                while len(self.pages) > self.max_users:
+                    self.pages.popitem(last=False)
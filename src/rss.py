@@ -19,6 +19,9 @@ import time
 import urllib
 from urllib.parse import urlparse
 
+import article_store
+import bodies
+import dna_vectors
 import logger
 import scraper
 
@@ -105,6 +108,23 @@ def textrazor_categorization(text):
 
 
 
+# links that failed to scrape are not fetched again for this many seconds, same as the
+# age after which feed items are skipped
+failed_scrape_ttl = 2592000
+
+def record_failed_scrape(failed_scrapes, links, source, reason):
+    """
+    params:  failed_scrapes - mongo collection of links that failed to scrape
+             links - list of normalized links of the article
+             source - string, name of the feed
+             reason - string, why the scrape failed, for diagnostics
+    """
+
+    now = datetime.datetime.utcnow()
+    for link in links:
+        failed_scrapes.update({'_id': link}, {'$set': {'source': source, 'reason': reason, 'failed_at': now}}, upsert=True)
+
+
 # ttl syntax collection-wide
 # collection.ensure_index('timestamp', expireAfterSeconds=2592000)
 #    index is timestamp_1
@@ -133,8 +153,17 @@ def parse_feed(url, debug=False, mode='streaming'):
 
     if mode == 'prototype':
         collection = db.prototype
+        body_collection = db.prototype_bodies
     else:
         collection = db.streaming
+        body_collection = db.bodies
+
+    body_collection.ensure_index('article_id')
+    body_collection.ensure_index('text_hash')
+
+    # negative cache of links that failed to scrape, keyed by normalized link
+    failed_scrapes = db.failed_scrapes
+    failed_scrapes.ensure_index('failed_at', expireAfterSeconds=failed_scrape_ttl)
 
     
     if 'npr.org' in url:
@@ -158,6 +187,8 @@ def parse_feed(url, debug=False, mode='streaming'):
     
     articles = []
     count = 0
+    # (article_id, timestamp, dna) of the inserted articles for the shared article store
+    stored_articles = []
     for item in feed['entries']:
         
         if debug and count == 100:
@@ -184,6 +215,10 @@ def parse_feed(url, debug=False, mode='streaming'):
             log.debug('Already found "'+ source + '" article: ' + rss_link)
             continue
 
+        if failed_scrapes.find_one({'_id': rss_link}) is not None:
+            log.debug('Skipping "'+ source + '" article that failed to scrape before: ' + rss_link)
+            continue
+
         title = item['title']
 
         try:
@@ -263,11 +298,13 @@ def parse_feed(url, debug=False, mode='streaming'):
         #
         # perform scrape (want to minimize this as much as possible, don't annoying hosts) 
         #
+        failure_reason = 'no text extracted'
         try:
             result = scraper.scraper(rss_link, debug)
         except UnicodeEncodeError:
             # sometimes finding non utf-8 unicode characters, for now skip
             result = None
+            failure_reason = 'non utf-8 character'
             log.warning('non utf-8 character in '+rss_link)
     
         full_text = None
@@ -306,19 +343,23 @@ def parse_feed(url, debug=False, mode='streaming'):
                     log.debug('Text too short on ' + og_link + '.  Skipping.')
                 else:
                     log.debug('Text too short on ' + rss_link + '.  Skipping.')
+
+                if mode == 'streaming' and not debug:
+                    record_failed_scrape(failed_scrapes, links, source, 'text too short')
                 continue
 
             # check to see if article is in DB based on the text 
             #   handles sources that get resyndicated (AP, CNN, ABC, etc.)
-            matching_articles = collection.find({'full_text': full_text})
-            if matching_articles.count() > 0:
+            #   bodies are looked up by the hash of their text, the text itself is not indexed
+            matching_ids = [ body['article_id'] for body in body_collection.find({'text_hash': bodies.text_hash(full_text)}, {'article_id': True, 'full_text': True}) if body['full_text'] == full_text ]
+            if len(matching_ids) > 0:
                 if og_url is not None:
                     log.debug('Already found "'+ source + '" article by text: ' + og_link)
                 else:
                     log.debug('Already found "'+ source + '" article by text: ' + rss_link)
 
                 # if text of article was already found, associate all links that point to that same article
-                for art in matching_articles:
+                for art in collection.find({'article_id': {'$in': matching_ids}}, {'links': True}):
                     new_links = list(art['links'])
                     if rss_link not in new_links:
                         new_links.append(rss_link)
@@ -357,6 +398,7 @@ def parse_feed(url, debug=False, mode='streaming'):
                             'published': published,
                             'timestamp': published_dt,
                             'topics': {'text_razor': topics },
+                            'dna': dna_vectors.pack(dna_vectors.topics_to_dna(topics)) if topics is not None else None,
                             'source': source
                             }
 
@@ -366,7 +408,12 @@ def parse_feed(url, debug=False, mode='streaming'):
             else:
                 
                 log.debug('Adding "'+ source + '" article: ' + links[0])
-                collection.insert(article_data)
+                metadata, body = bodies.split_article(article_data)
+                # body first, the article is servable as soon as its metadata is inserted
+                body_collection.insert(body)
+                collection.insert(metadata)
+                if mode == 'streaming':
+                    stored_articles.append((article_id, published_dt, dna_vectors.topics_to_dna(topics)))
 
             count += 1
 
@@ -381,28 +428,29 @@ def parse_feed(url, debug=False, mode='streaming'):
                 article_data = { 'links': links, 'full_text': None, 'display_text': None, 'source': source }
                 articles.append(article_data)
 
-            # in streaming mode, append all links that failed to scrape to reduce website access
-            if mode == 'streaming':
+            # in streaming mode, remember all links that failed to scrape to reduce website access
+            if mode == 'streaming' and not debug:
 
                 if og_url is None:
                     links = [rss_link]
                 else:
                     links = [rss_link, og_link]
 
-                article_data = {'article_id': article_id,
-                                'full_text': None,
-                                'display_text': None,
-                                'links': links,
-                                'source': source,
-                                'timestamp': published_dt
-                                }
-                
-                if not debug:
-                    collection.insert(article_data)
+                record_failed_scrape(failed_scrapes, links, source, failure_reason)
             
             
     log.info('Added ' + str(count) + ' articles from ' + source)
 
+    try:
+        store = article_store.ArticleStore()
+        if mode == 'streaming' and not debug and store.current_generation() is None:
+            # first feed after the deploy, start the store with the articles of the whole window
+            store.rebuild(collection)
+        else:
+            store.append(stored_articles)
+    except (IOError, OSError) as e:
+        log.warning('Failed to update article store, run mongo_tools.rebuild_article_store to add the missing articles: ' + str(e))
+
     if debug:
         return articles
 
@@ -541,7 +589,7 @@ def update_db():
         log.warning('Failed to connect to mongo.')
 
     db = client.noozli
-    collection = db.streaming
+    collection = db.bodies
 
     for article in collection.find():
         if article['display_text'] is None:
@@ -3,6 +3,10 @@ sys.path.append('../src/algos')
 sys.path.append('../src')
 
 import algo
+import dna_vectors
+import itertools
+import random
+import replay
 
 def test_engagement_mapping_bad():
     
@@ -138,3 +142,94 @@ def test_article_to_dna():
             correct = False
         
     assert correct
+
+def test_score_articles_matches_inner_product():
+
+    user_dna = [0.9, 0.1, 0.4, 0.2, 0.5, 0.3, 0.8, 0.1, 0.0, 0.6, 0.2, 0.1, 0.3, 0.7, 0.5, 0.4, 0.2, 0.6, 0.1, 0.3]
+    articles = [ {'topics': {'text_razor': [[u'Culture', 1], [u'Technology', 0.708148], [u'Business', 0.670305], [u'Science', 0.568386]]}},
+                 {'topics': {'text_razor': [[u'Politics', 1], [u'Law', 0.868527], [u'Culture', 0.671432], [u'Violence', 0.441865]]}},
+                 {'topics': {'text_razor': [[u'Sports', 1], [u'Leisure', 0.623654], [u'Language', 0.345093], [u'Belief', 0.202001]]}} ]
+
+    # reference: zero out each of the 5 top buckets in the article dna, one at a time
+    user_dna_copy = list(user_dna)
+    top_buckets = []
+    for i in range(5):
+        top_buckets.append(algo.topic_to_bucket[algo.index_to_topic[user_dna_copy.index(max(user_dna_copy))]])
+        for category in top_buckets[-1]:
+            user_dna_copy[algo.topic_to_index[category]] = 0
+
+    scores = algo.score_articles(algo.article_dna_matrix([ dna_vectors.article_dna(art) for art in articles ]), user_dna, algo.bucket_masks(user_dna))
+
+    correct = True
+    for row in range(len(articles)):
+        art_dna = algo.article_to_dna_mapping(articles[row]['topics']['text_razor'])
+        expected = [algo.inner_product(art_dna, user_dna)]
+        for bucket in top_buckets:
+            art_dna_copy = list(art_dna)
+            for category in bucket:
+                art_dna_copy[algo.topic_to_index[category]] = 0
+            expected.append(algo.inner_product(art_dna_copy, user_dna))
+
+        for col in range(6):
+            if abs(scores[row, col] - expected[col]) > 1e-6:
+                correct = False
+
+    assert correct
+
+def test_packed_article_dna():
+
+    topics = [[u'Culture', 1], [u'Technology', 0.708148], [u'Business', 0.670305], [u'Science', 0.568386], [u'Leisure', 0.466582], [u'Politics', 0.438614]]
+    packed = dna_vectors.pack(dna_vectors.topics_to_dna(topics))
+
+    assert len(packed) == 80
+
+    unpacked = dna_vectors.article_dna({'dna': packed})
+    expected = algo.article_to_dna_mapping(topics)
+    assert all(abs(unpacked[i] - expected[i]) < 1e-6 for i in range(20))
+
+    # documents without a packed field fall back to the topics
+    fallback = dna_vectors.article_dna({'topics': {'text_razor': topics}})
+    assert all(abs(fallback[i] - expected[i]) < 1e-6 for i in range(20))
+
+def test_top_indices_matches_full_sort():
+
+    scores = algo.np.array([[0.1, 0.9, 0.3], [0.8, 0.2, 0.3], [0.5, 0.4, 0.7], [0.3, 0.6, 0.1], [0.9, 0.1, 0.2]])
+    top = algo.top_indices(scores, 3)
+
+    correct = True
+    for col in range(scores.shape[1]):
+        expected = sorted(range(len(scores)), key=lambda row: scores[row, col], reverse=True)[:3]
+        if list(top[:, col]) != expected:
+            correct = False
+
+    assert correct
+
+
+def test_replay_engagement_coeffs_match_engagement_mapping():
+
+    # every branch of engagement_mapping and the values on both sides of its thresholds
+    analytics = [ {'action': action, 'total_time': total_time, 'time_zero': 0, 'down': down, 'up': 0, 'percent': percent, 'share': share}
+                  for action, total_time, down, percent, share in itertools.product(['done', 'save'], [0, 20, 21, 60, 61], [0, 1, 2, 3, 4], [85, 86], [[], ['twitter']]) ]
+
+    assert replay.engagement_coeffs(analytics, 1).tolist() == [ algo.engagement_mapping(data, 1) for data in analytics ]
+
+
+def test_replay_dna_matches_update_dna():
+
+    random.seed(3)
+    article_dna = [ [ random.choice([0.0, random.random()]) for i in range(20) ] for j in range(25) ]
+    rule = algo.WeightedAverage('6bc3a6b4-568e-4e0b-bfcd-256231e03e7c')
+
+    events = []
+    expected = []
+    for user in range(10):
+        rows = [ random.randrange(25) for i in range(random.randint(0, 30)) ]
+        coeffs = [ random.choice([0.0, 0.0625, 0.125, 0.3125, .4375, 0.5]) for row in rows ]
+        events.append((algo.np.array(rows, dtype=int), algo.np.array(coeffs)))
+
+        user_dna = [0.5] * 20
+        for row, coeff in zip(rows, coeffs):
+            user_dna = rule.update_dna(user_dna, article_dna[row], coeff, 1)
+        expected.append(user_dna)
+
+    assert algo.np.allclose(replay.replay_dna(events, algo.np.array(article_dna), 1), expected)
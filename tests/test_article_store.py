@@ -0,0 +1,79 @@
+import sys
+sys.path.append('../src')
+
+import article_store
+import datetime
+import dna_vectors
+import numpy as np
+import os
+import tempfile
+import test_candidates
+
+
+def test_append_and_window():
+
+    path = tempfile.mkdtemp()
+    writer = article_store.ArticleStore(path)
+    reader = article_store.ArticleStore(path)
+
+    assert reader.window(datetime.datetime(2015, 1, 1), datetime.datetime(2015, 1, 2)) is None
+
+    now = datetime.datetime(2015, 6, 1, 12)
+    articles = []
+    for i in range(10):
+        dna = np.zeros(dna_vectors.dna_length)
+        dna[i] = 0.5
+        articles.append(('%032d' % i, now - datetime.timedelta(hours=i), dna))
+
+    writer.append(articles[:5], now=now)
+    ids, timestamps, dna = reader.window(now - datetime.timedelta(hours=24), now + datetime.timedelta(hours=1))
+    assert ids == [ '%032d' % i for i in range(4, -1, -1) ]
+    assert isinstance(dna, np.memmap)
+
+    # a new generation is picked up by the reader
+    writer.append(articles[5:], now=now)
+    ids, timestamps, dna = reader.window(now - datetime.timedelta(hours=24), now + datetime.timedelta(hours=1))
+    assert ids == [ '%032d' % i for i in range(9, -1, -1) ]
+    assert list(timestamps) == sorted(timestamps)
+    assert np.allclose(dna[ids.index('%032d' % 3)], articles[3][2])
+
+    # windows include start and exclude end
+    ids, timestamps, dna = reader.window(now - datetime.timedelta(hours=3), now - datetime.timedelta(hours=1))
+    assert ids == [ '%032d' % 3, '%032d' % 2 ]
+
+    # only the current and previous generation stay on disk
+    writer.append([('%032d' % 10, now, np.zeros(dna_vectors.dna_length))], now=now)
+    assert sorted(name for name in os.listdir(path) if name.startswith('dna.')) == ['dna.2.npy', 'dna.3.npy']
+
+
+def test_append_drops_expired():
+
+    path = tempfile.mkdtemp()
+    store = article_store.ArticleStore(path)
+
+    now = datetime.datetime(2015, 6, 1, 12)
+    store.append([('old', now - datetime.timedelta(hours=200), np.zeros(dna_vectors.dna_length)),
+                  ('new', now - datetime.timedelta(hours=1), np.zeros(dna_vectors.dna_length))], now=now)
+
+    ids, timestamps, dna = store.window(now - datetime.timedelta(hours=1000), now)
+    assert ids == ['new']
+
+
+def test_rebuild_adds_missing_articles_once():
+
+    path = tempfile.mkdtemp()
+    store = article_store.ArticleStore(path)
+
+    now = datetime.datetime(2015, 6, 1, 12)
+    collection = test_candidates.FakeCollection()
+    for i in range(4):
+        collection.insert(test_candidates.make_article('%032d' % i, i, now))
+    collection.insert(test_candidates.make_article('old', 200, now))
+
+    # the append of article 0 went through, the others failed
+    store.append([('%032d' % 0, now, np.zeros(dna_vectors.dna_length))], now=now)
+
+    assert store.rebuild(collection, now=now) == 4
+    ids, timestamps, dna = store.window(now - datetime.timedelta(hours=24), now + datetime.timedelta(hours=1))
+    assert ids == [ '%032d' % i for i in range(3, -1, -1) ]
+    assert np.allclose(dna[ids.index('%032d' % 0)], dna_vectors.topics_to_dna([['Science', 1]]))
@@ -0,0 +1,89 @@
+import sys
+sys.path.append('../src')
+
+import bloom
+
+
+def test_bloom_no_false_negatives():
+
+    bloom_filter = bloom.BloomFilter()
+    article_ids = [ str(i) + 'fcce9e950368569c72d1dae0c3023a94' for i in range(1000) ]
+    for article_id in article_ids:
+        bloom_filter.add(article_id)
+
+    assert all(article_id in bloom_filter for article_id in article_ids)
+
+    # reload from the stored blob
+    loaded = bloom.BloomFilter(bits=bloom_filter.to_bytes())
+    assert all(article_id in loaded for article_id in article_ids)
+
+    false_positives = sum(1 for i in range(10000) if str(i) + 'unserved' in loaded)
+    assert false_positives < 100
+
+
+def test_served_filter_rotation():
+
+    served_filter = bloom.ServedFilter(10)
+    served_filter.add('old')
+
+    served_filter.rotate(11)
+    served_filter.add('new')
+    assert 'old' in served_filter and 'new' in served_filter
+
+    served_filter.rotate(12)
+    assert 'old' not in served_filter and 'new' in served_filter
+
+    served_filter.rotate(14)
+    assert 'new' not in served_filter
+
+
+def test_bloom_sized_for_served_count():
+
+    assert bloom.size_for(0) == bloom.default_size
+    bloom_filter = bloom.BloomFilter(size=bloom.size_for(5000))
+    assert bloom_filter.capacity() >= 10000
+
+    article_ids = [ str(i) + 'served' for i in range(5000) ]
+    for article_id in article_ids:
+        bloom_filter.add(article_id)
+
+    false_positives = sum(1 for i in range(10000) if str(i) + 'unserved' in bloom_filter)
+    assert false_positives < 100
+
+    # the count of a loaded filter is estimated from its bits
+    loaded = bloom.BloomFilter(bits=bloom_filter.to_bytes())
+    assert abs(loaded.count - 5000) < 250
+
+
+def test_served_filter_full_and_rebuild():
+
+    served_filter = bloom.ServedFilter(10)
+    article_ids = set( str(i) + 'served' for i in range(2000) )
+    for article_id in article_ids:
+        served_filter.add(article_id)
+    assert served_filter.full()
+
+    served_filter.rebuild(article_ids)
+    assert not served_filter.full()
+    assert served_filter.current.size == bloom.size_for(2000)
+    assert all(article_id in served_filter for article_id in article_ids)
+
+
+def test_served_filter_merge():
+
+    first = bloom.ServedFilter(10)
+    second = bloom.ServedFilter(10)
+    first.add('first')
+    second.add('second')
+
+    assert first.merge(second.generation, second.current.to_bytes(), second.previous.to_bytes())
+    assert 'first' in first and 'second' in first
+
+    # a stored filter from an older period is rotated before merging
+    older = bloom.ServedFilter(9)
+    older.add('older')
+    assert first.merge(older.generation, older.current.to_bytes(), older.previous.to_bytes())
+    assert 'older' in first and first.generation == 10
+
+    grown = bloom.ServedFilter(10, size=bloom.size_for(5000))
+    assert not first.merge(grown.generation, grown.current.to_bytes(), grown.previous.to_bytes())
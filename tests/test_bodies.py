@@ -0,0 +1,19 @@
+import sys
+sys.path.append('../src')
+
+import bodies
+
+
+def test_split_article():
+
+    article_data = {'article_id': 'a', 'title': 'title', 'links': ['http://example.com/a'], 'summary': 'summary',
+                    'full_text': 'text', 'display_text': '<p>text</p>', 'source': 'source'}
+
+    metadata, body = bodies.split_article(article_data)
+
+    assert metadata == {'article_id': 'a', 'title': 'title', 'links': ['http://example.com/a'], 'source': 'source', 'has_text': True}
+    assert body == {'article_id': 'a', 'summary': 'summary', 'full_text': 'text', 'display_text': '<p>text</p>', 'text_hash': bodies.text_hash('text')}
+
+    metadata, body = bodies.split_article({'article_id': 'b', 'full_text': None, 'display_text': None, 'links': []})
+
+    assert metadata == {'article_id': 'b', 'links': [], 'has_text': False} and body is None
@@ -0,0 +1,181 @@
+import sys
+sys.path.append('../src/algos')
+sys.path.append('../src')
+
+import candidates
+import datetime
+import dna_vectors
+import numpy as np
+import random
+
+
+class FakeCursor(list):
+
+    def sort(self, key, direction):
+        return FakeCursor(sorted(self, key=lambda doc: doc[key], reverse=direction < 0))
+
+
+def matches(value, condition):
+    if not isinstance(condition, dict):
+        return value == condition
+    return all(value is not None and ((op == '$gte' and value >= arg) or (op == '$gt' and value > arg) or (op == '$in' and value in arg))
+               for op, arg in condition.items())
+
+
+class FakeCollection:
+    """
+    minimal stand in for a mongo collection, only supports the queries of the candidate index
+    """
+
+    def __init__(self):
+        self.docs = []
+
+    def insert(self, doc):
+        doc['_id'] = len(self.docs) + 1
+        self.docs.append(doc)
+
+    def find(self, query, projection):
+        docs = [ doc for doc in self.docs if all(matches(doc.get(k), condition) for k, condition in query.items()) ]
+        return FakeCursor([ {k: v for k, v in doc.items() if k == '_id' or k in projection} for doc in docs ])
+
+
+def make_article(article_id, hours_old, now):
+    return {'article_id': article_id, 'title': article_id, 'has_text': True, 'author': None,
+            'links': ['http://example.com/' + article_id], 'timestamp': now - datetime.timedelta(hours=hours_old),
+            'topics': {'text_razor': [['Science', 1]]}}
+
+
+def test_windows_and_incremental_refresh():
+
+    now = datetime.datetime.utcnow()
+    collection = FakeCollection()
+    collection.insert(make_article('a', 0.5, now))
+    collection.insert(make_article('b', 2.5, now))
+    collection.insert(make_article('c', 100, now))
+    collection.insert(make_article('old', 200, now))
+    collection.insert({'article_id': 'failed', 'has_text': False, 'links': ['http://example.com/failed'], 'timestamp': now})
+
+    index = candidates.CandidateIndex(collection)
+    windows = index.windows(now)
+
+    assert [ [art.article_id for art in window] for window in windows ] == [['a'], [], ['b'], [], [], [], ['c']]
+    assert not hasattr(windows[0][0], '__dict__') and candidates.response_doc(windows[0][0])['link'] == 'http://example.com/a'
+    assert sorted(candidates.response_doc(windows[0][0]).keys()) == ['article_id', 'link', 'title']
+
+    collection.insert(make_article('d', 0.25, now))
+    index.refresh(force=True)
+
+    assert [ art.article_id for art in index.windows(now)[0] ] == ['a', 'd']
+    assert index.version == 2
+
+
+def test_display_text_read_from_bodies():
+
+    now = datetime.datetime.utcnow()
+    collection = FakeCollection()
+    bodies = FakeCollection()
+    for article_id in ['a', 'b', 'nobody']:
+        collection.insert(make_article(article_id, 1.5, now))
+    for article_id in ['a', 'b']:
+        bodies.insert({'article_id': article_id, 'full_text': 'text', 'display_text': '<p>' + article_id + '</p>'})
+
+    index = candidates.CandidateIndex(collection, bodies)
+    window = index.windows(now)[1]
+
+    assert [ candidates.response_doc(art)['display_text'] for art in window ] == ['<p>a</p>', '<p>b</p>']
+    assert 'display_text' not in candidates.response_doc(window[0], candidates.list_fields)
+
+
+def test_memory_cap_evicts_oldest():
+
+    now = datetime.datetime.utcnow()
+    collection = FakeCollection()
+    for i in range(5):
+        collection.insert(make_article(str(i), i, now))
+
+    index = candidates.CandidateIndex(collection, max_articles=3)
+    index.refresh(force=True)
+
+    assert sorted(index.article_ids) == ['0', '1', '2']
+    assert sorted(entry[2].article_id for entries in index.postings.values() for entry in entries) == ['0', '1', '2']
+
+
+def test_eviction_changes_version():
+
+    now = datetime.datetime.utcnow()
+    collection = FakeCollection()
+    collection.insert(make_article('a', 1, now))
+    collection.insert(make_article('b', 100, now))
+
+    index = candidates.CandidateIndex(collection)
+    index.refresh(force=True)
+    version = index.version
+
+    # nothing new, nothing aged out
+    index.refresh(force=True)
+    assert index.version == version
+
+    serve_window = candidates.serve_window
+    candidates.serve_window = datetime.timedelta(hours=50)
+    try:
+        index.refresh(force=True)
+    finally:
+        candidates.serve_window = serve_window
+
+    assert sorted(index.article_ids) == ['a']
+    assert index.version == version + 1
+
+
+def test_top_k_matches_full_scan():
+
+    random.seed(7)
+    now = datetime.datetime.utcnow()
+    collection = FakeCollection()
+    for i in range(300):
+        art = make_article(str(i), random.uniform(0, 10), now)
+        topics = [ [topic, round(random.random(), 3)] for topic in random.sample(sorted(dna_vectors.topic_to_index), 4) ]
+        art['topics'] = {'text_razor': topics}
+        art['dna'] = dna_vectors.pack(dna_vectors.topics_to_dna(topics))
+        collection.insert(art)
+
+    index = candidates.CandidateIndex(collection)
+    index.refresh(force=True)
+
+    weights = np.array([ random.random() if i % 3 else 0 for i in range(20) ])
+    start = now - datetime.timedelta(hours=8)
+    end = now - datetime.timedelta(hours=1)
+    accept = lambda art: int(art.article_id) % 5 != 0
+
+    expected = sorted([ art for art in index.articles if start <= art.timestamp < end and accept(art) ],
+                      key=lambda art: float(np.dot(weights, art.dna)), reverse=True)
+
+    assert [ art.article_id for art in index.top_k(weights, start, end, k=3, accept=accept) ] == [ art.article_id for art in expected[:3] ]
+
+    # nothing scores above zero, fall back to the earliest accepted articles of the window
+    assert len(index.top_k(np.zeros(20), start, end, k=2, accept=accept)) == 2
+
+
+def test_engagement_counts():
+
+    now = datetime.datetime.utcnow()
+    collection = FakeCollection()
+    for article_id in ['a', 'b', 'c']:
+        collection.insert(make_article(article_id, 1.5, now))
+
+    stored = {'a': (3, 1), 'b': (0, 2)}
+    index = candidates.CandidateIndex(collection, engagement=lambda article_ids: {k: v for k, v in stored.items() if k in article_ids})
+    index.refresh()
+
+    assert [ (index.get(k).positive, index.get(k).negative) for k in ['a', 'b', 'c'] ] == [(3, 1), (0, 2), (0, 0)]
+    assert index.get('a').popularity() > index.get('c').popularity() == 0.5 > index.get('b').popularity()
+
+    # engagements posted to this process count right away, the next load replaces them
+    index.add_engagement('c', True)
+    index.add_engagement('missing', True)
+    assert index.get('c').positive == 1
+
+    # rankings memoized with the old counts are dropped
+    version = index.version
+    index.load_engagement()
+    assert index.get('c').positive == 0
+    assert index.version == version + 1
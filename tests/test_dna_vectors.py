@@ -0,0 +1,29 @@
+import sys
+sys.path.append('../src')
+
+import dna_vectors
+import pytest
+
+
+def test_user_dna_round_trip():
+
+    dna = [ i / 20 for i in range(20) ]
+
+    packed, version = dna_vectors.pack_user_dna(dna)
+
+    assert len(packed) == 80 and version == dna_vectors.user_dna_version
+    assert dna_vectors.unpack_user_dna(packed, version) == pytest.approx(dna)
+
+
+def test_user_dna_length_checked_against_version():
+
+    packed = dna_vectors.pack([0.5] * 10)
+
+    with pytest.raises(ValueError):
+        dna_vectors.unpack_user_dna(packed, 1)
+
+
+def test_pack_user_dna_checks_length():
+
+    with pytest.raises(ValueError):
+        dna_vectors.pack_user_dna([0.5] * 10)
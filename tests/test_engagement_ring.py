@@ -0,0 +1,32 @@
+import sys
+sys.path.append('../src')
+
+import engagement_ring
+import random
+
+
+def test_success_rates_match_history():
+
+    random.seed(5)
+    history = [ random.random() < 0.3 for i in range(300) ]
+
+    bits, count = engagement_ring.empty()
+    for i in range(0, len(history), 7):
+        bits, count = engagement_ring.push(bits, count, history[i:i+7])
+
+    newest_first = list(reversed(history))
+    assert count == engagement_ring.ring_size and len(bits) == 16
+    for n in [1, 10, 100, 128]:
+        assert engagement_ring.success_rate(bits, count, n) == sum(newest_first[:n]) / n
+
+    assert engagement_ring.from_history(newest_first[:100]) == engagement_ring.push(*engagement_ring.empty(), positives=history[-100:])
+
+
+def test_short_history():
+
+    bits, count = engagement_ring.from_history([True, False, False])
+
+    assert count == 3
+    assert engagement_ring.success_rate(bits, count, 10) == 1 / 3
+    assert engagement_ring.success_rate(bits, count, 1) == 1.0
+    assert engagement_ring.success_rate(*engagement_ring.empty(), n=10) is None
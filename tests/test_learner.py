@@ -0,0 +1,51 @@
+import sys
+sys.path.append('../src')
+
+import learner
+import threading
+
+
+def test_jobs_run_in_order_per_user():
+
+    learned = []
+    done = []
+    learning = learner.Learner(lambda user_id, analytics, algo: learned.append((user_id, analytics)), done=done.append)
+
+    for i in range(20):
+        assert learning.submit('user-' + str(i % 3), i, 1)
+    learning.shutdown()
+
+    for user in range(3):
+        assert [ analytics for user_id, analytics in learned if user_id == 'user-' + str(user) ] == list(range(user, 20, 3))
+    assert len(done) == 20
+
+    assert not learning.submit('user-0', 20, 1)
+
+
+def test_full_queue_drops_jobs():
+
+    release = threading.Event()
+    learning = learner.Learner(lambda user_id, analytics, algo: release.wait(), workers=1, max_queued=2)
+
+    accepted = [ learning.submit('user', i, 1) for i in range(5) ]
+    assert accepted.count(False) >= 2
+
+    release.set()
+    learning.shutdown()
+
+
+def test_failed_job_does_not_stop_worker():
+
+    learned = []
+
+    def learn(user_id, analytics, algo):
+        if analytics == 0:
+            raise ValueError('bad analytics')
+        learned.append(analytics)
+
+    learning = learner.Learner(learn, workers=1)
+    learning.submit('user', 0, 1)
+    learning.submit('user', 1, 1)
+    learning.shutdown()
+
+    assert learned == [1]
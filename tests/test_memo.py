@@ -0,0 +1,23 @@
+import sys
+sys.path.append('../src/algos')
+
+import memo
+
+
+def test_cold_start_users_share_a_ranking():
+
+    ranking_memo = memo.RankingMemo()
+    key = ('WeightedAverage', ranking_memo.fingerprint([0.5]*20))
+
+    assert ranking_memo.fingerprint([0.51]*20) == key[1]
+    assert ranking_memo.get(key, 1) is None
+    assert not ranking_memo.remember(key)
+    assert ranking_memo.remember(key)
+
+    ranking_memo.put(key, 1, ['ranked'])
+    assert ranking_memo.get(key, 1) == ['ranked']
+
+    # new articles were ingested
+    assert ranking_memo.get(key, 2) is None
+    ranking_memo.put(key, 1, ['stale'])
+    assert ranking_memo.get(key, 2) is None
@@ -0,0 +1,62 @@
+import sys
+sys.path.append('../src')
+
+import prefetch
+import threading
+import time
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_page_computed_before_invalidate_is_discarded():
+
+    started = threading.Event()
+    release = threading.Event()
+    computed = []
+
+    def compute(user_id, count):
+        started.set()
+        release.wait()
+        computed.append(user_id)
+        return ['stale'], [0.5], 1
+
+    cache = prefetch.PageCache(compute)
+    cache.schedule('user', 1)
+    started.wait()
+
+    # articles served and recorded while the page was being computed
+    cache.invalidate('user')
+    release.set()
+    wait_for(lambda: len(computed) == 1 and len(cache.generations) == 0)
+
+    assert cache.take('user', 1, [0.5], 1) is None
+    assert cache.generations == {}
+
+
+def test_page_taken_when_valid():
+
+    cache = prefetch.PageCache(lambda user_id, count: (['a', 'b'], [0.5], 1))
+    cache.schedule('user', 2)
+    wait_for(lambda: 'user' in cache.pages)
+
+    assert cache.take('user', 2, [0.4], 1) is None
+
+    cache.schedule('user', 2)
+    wait_for(lambda: 'user' in cache.pages)
+
+    assert cache.take('user', 1, [0.5], 1) == ['a']
+
+
+def test_counts_are_bounded():
+
+    cache = prefetch.PageCache(lambda user_id, count: (None, None, None), max_users=3)
+    for i in range(10):
+        cache.schedule('user-' + str(i), i)
+    wait_for(lambda: len(cache.pending) == 0)
+
+    assert list(cache.counts) == ['user-7', 'user-8', 'user-9']
+    assert cache.pages == {} and cache.generations == {}
@@ -0,0 +1,46 @@
+import sys
+sys.path.append('../src')
+sys.path.append('../src/algos')
+
+import numpy as np
+import random
+import replay
+
+
+def make_analytics(action='read', total_time=0, percent=0, down=0, share=[]):
+    return {'action': action, 'total_time': total_time, 'time_zero': 0, 'percent': percent, 'up': 0, 'down': down, 'share': share}
+
+
+def test_engagement_coeffs():
+
+    analytics = [
+        make_analytics(share=['twitter'], action='save'),
+        make_analytics(action='save', down=5),
+        make_analytics(total_time=61, down=3, percent=86),
+        make_analytics(total_time=61, down=2, percent=86),
+        make_analytics(total_time=10, down=1),
+        make_analytics(total_time=100, percent=100),
+    ]
+
+    assert replay.engagement_coeffs(analytics, 1).tolist() == [0.5, 0.0625, .4375, 0.3125, 0.125, 0.0]
+
+
+def test_batch_replay_matches_single_user_replay():
+
+    # users replayed in lockstep, with different numbers of events, get the dna each would get alone
+    random.seed(7)
+    article_dna = np.array([ [ random.choice([0.0, random.random()]) for i in range(20) ] for j in range(30) ])
+
+    events = []
+    for user in range(12):
+        count = random.randint(0, 40)
+        events.append((np.array([ random.randrange(30) for i in range(count) ]),
+                       np.array([ random.choice([0.0, 0.0625, 0.125, 0.3125, .4375, 0.5]) for i in range(count) ])))
+
+    result = replay.replay_dna(events, article_dna, 1)
+
+    for user, user_events in enumerate(events):
+        assert np.allclose(result[user], replay.replay_dna([user_events], article_dna, 1)[0])
+
+    # no events, dna of a new user
+    assert np.allclose(replay.replay_dna([(np.zeros(0, dtype=int), np.zeros(0))], article_dna, 1), 0.5)
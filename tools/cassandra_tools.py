@@ -0,0 +1,118 @@
+import sys
+sys.path.append('../src')
+
+import dna_vectors
+import json
+import multiprocessing
+
+from cassandra.cluster import Cluster
+from cassandra.query import SimpleStatement
+
+# token range of the Murmur3Partitioner
+min_token = -2**63
+max_token = 2**63 - 1
+
+session = None
+
+
+def token_ranges(parts):
+    """
+    split the token ring into parts, each worker of a full table scan reads one
+
+    :param parts: int, number of ranges
+    :returns: list of (start, end) tuples, a row belongs to a range if start < token(id) <= end
+    """
+
+    step = (max_token - min_token) // parts
+    ranges = []
+    for i in range(parts):
+        start = min_token + i * step
+        end = max_token if i == parts - 1 else start + step
+        ranges.append((start, end))
+    return ranges
+
+
+def connect(nodes=['127.0.0.1']):
+    """
+    open one session per worker process, sessions can not be shared across a fork
+    """
+
+    global session
+    session = Cluster(nodes).connect()
+
+
+def convert_dna_range(token_range, fetch_size=1000, in_flight=100):
+    """
+    write dna_blob and dna_version for the users in a token range that only have the json
+    dna text
+
+    the blob is written with the write time of the text plus one microsecond instead of
+    the current time.  a dna the api writes with set_dna after the text, whether before or
+    after the row is read here, carries a later timestamp and wins over the converted one.
+    this holds as long as the clocks of the api hosts are not behind by more than the age
+    of the text
+
+    :param token_range: (start, end) from token_ranges
+    :returns: (converted, skipped, failed) counts
+    """
+
+    update_cql = session.prepare("UPDATE noozli.users USING TIMESTAMP ? SET dna_blob = ?, dna_version = ?, dna = null WHERE id = ?;")
+    query = SimpleStatement("SELECT id, dna, dna_blob, WRITETIME(dna) FROM noozli.users WHERE token(id) > %s AND token(id) <= %s;", fetch_size=fetch_size)
+
+    converted = 0
+    skipped = 0
+    failed = 0
+
+    futures = []
+    for user_id, dna, dna_blob, dna_written in session.execute(query, token_range):
+        if dna_blob is not None or dna is None:
+            skipped += 1
+            continue
+
+        try:
+            dna_blob, dna_version = dna_vectors.pack_user_dna(json.loads(dna)['dna'])
+        except (KeyError, TypeError, ValueError) as e:
+            print('Failed to convert dna of ' + str(user_id) + ': ' + str(e))
+            failed += 1
+            continue
+
+        futures.append(session.execute_async(update_cql.bind((dna_written + 1, dna_blob, dna_version, user_id))))
+
+        if len(futures) >= in_flight:
+            for future in futures:
+                future.result()
+            converted += len(futures)
+            futures = []
+
+    for future in futures:
+        future.result()
+    converted += len(futures)
+
+    return converted, skipped, failed
+
+
+def convert_dna(processes=4, parts=64):
+    """
+    move the dna of all users from the json dna text to the packed dna_blob column, see
+    database.user_dna.  runs while the api is serving, rows are read and converted by
+    token range in parallel and the migration can be stopped and run again, see
+    convert_dna_range for how dna written by the api meanwhile is kept.
+
+    run after the schema upgrade that adds dna_blob and dna_version
+
+    :param processes: int, worker processes
+    :param parts: int, token ranges, more ranges than processes keeps the workers busy until the end
+    :returns: (converted, skipped, failed) counts
+    """
+
+    pool = multiprocessing.Pool(processes, initializer=connect)
+
+    totals = [0, 0, 0]
+    for counts in pool.imap_unordered(convert_dna_range, token_ranges(parts)):
+        totals = [ total + count for total, count in zip(totals, counts) ]
+        print('Converted ' + str(totals[0]) + ', skipped ' + str(totals[1]) + ', failed ' + str(totals[2]))
+
+    pool.close()
+    pool.join()
+
+    return tuple(totals)
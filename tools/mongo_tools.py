@@ -1,4 +1,10 @@
+import sys
+sys.path.append('../src')
+
+import article_store
+import bodies
 import datetime
+import dna_vectors
 import pymongo
 
 
@@ -19,10 +25,9 @@ def articles_per_day():
 
     current_dt = datetime.datetime(now.year, now.month, now.day) - datetime.timedelta(hours=24)
 
-    # this count is inaccurate, need to check for None is display_text
     article_counts = []
     for i in range(30):
-        article_counts.append(collection.find({"timestamp": {"$gte": current_dt - datetime.timedelta(hours=24), "$lt": current_dt}}).count())
+        article_counts.append(collection.find({"timestamp": {"$gte": current_dt - datetime.timedelta(hours=24), "$lt": current_dt}, "has_text": True}).count())
         current_dt -= datetime.timedelta(hours=24)
 
     return article_counts
@@ -61,8 +66,8 @@ def topic_percentages(thres=0):
         'Weather': 0
         }
     
-    for post in collection.find():
-        if post['display_text'] is not None:
+    for post in collection.find({'has_text': True}, {'topics': True}):
+        if post['topics']['text_razor'] is not None:
             for topic in post['topics']['text_razor']:
                 if topic[1] > thres:
                     topic_counts[topic[0]] += 1
@@ -114,16 +119,130 @@ def topics_by_day(thres=0):
         for key in topic_counts.keys():
             topic_counts[key].append(0)
 
-        for post in collection.find({"timestamp": {"$gte": current_dt - datetime.timedelta(hours=24), "$lt": current_dt}}):
-            if post['display_text'] is not None:
-                try:
-                    for topic in post['topics']['text_razor']:
-                        if topic[1] > thres:
-                            topic_counts[topic[0]][-1] += 1
-                except:
-                    no_topics[-1] += 1
+        for post in collection.find({"timestamp": {"$gte": current_dt - datetime.timedelta(hours=24), "$lt": current_dt}, "has_text": True}, {'topics': True}):
+            try:
+                for topic in post['topics']['text_razor']:
+                    if topic[1] > thres:
+                        topic_counts[topic[0]][-1] += 1
+            except:
+                no_topics[-1] += 1
 
         current_dt -= datetime.timedelta(hours=24)
 
     return topic_counts, no_topics
-    
+
+
+def backfill_article_dna():
+    """
+    store the packed dna vector on articles inserted before rss.parse_feed computed it
+    """
+
+    try:
+        client = pymongo.MongoClient('localhost', 27017)
+    except Exception as e:
+        print('Failed to connect to mongo')
+
+    db = client.noozli
+    collection = db.streaming
+
+    updated = 0
+    for post in collection.find({'dna': {'$exists': False}, 'has_text': True}, {'topics': True}):
+        try:
+            topics = post['topics']['text_razor']
+        except KeyError:
+            topics = None
+
+        if topics is None:
+            dna = None
+        else:
+            dna = dna_vectors.pack(dna_vectors.topics_to_dna(topics))
+
+        collection.update({'_id': post['_id']}, {'$set': {'dna': dna}})
+        updated += 1
+
+    return updated
+
+
+def rebuild_article_store():
+    """
+    add the articles of db.streaming the shared article store is missing, e.g. after
+    rss.parse_feed failed to append them.  safe to run while the ingester appends
+    """
+
+    try:
+        client = pymongo.MongoClient('localhost', 27017)
+    except Exception as e:
+        print('Failed to connect to mongo')
+
+    return article_store.ArticleStore().rebuild(client.noozli.streaming)
+
+
+def split_article_bodies(batch_size=500):
+    """
+    move full_text, summary and display_text of articles inserted before the split from
+    db.streaming to db.bodies.  articles are marked with has_text once moved, so the
+    migration can be stopped and run again.
+
+    run before deploying the api and scraper that read db.bodies, then compact db.streaming
+    to give the space back
+    """
+
+    try:
+        client = pymongo.MongoClient('localhost', 27017)
+    except Exception as e:
+        print('Failed to connect to mongo')
+
+    db = client.noozli
+    collection = db.streaming
+    body_collection = db.bodies
+
+    body_collection.ensure_index('article_id')
+    body_collection.ensure_index('text_hash')
+    collection.ensure_index('has_text')
+
+    moved = 0
+    for post in collection.find({'has_text': {'$exists': False}}).batch_size(batch_size):
+        metadata, body = bodies.split_article(post)
+
+        # body first, a stopped run leaves the article unmigrated but never without its body
+        if body is not None:
+            body_collection.update({'article_id': body['article_id']}, {'$set': body}, upsert=True)
+
+        collection.update({'_id': post['_id']}, {'$set': {'has_text': metadata['has_text']}, '$unset': {field: '' for field in bodies.body_fields}})
+        moved += 1
+
+        if moved % 10000 == 0:
+            print('Moved ' + str(moved) + ' articles')
+
+    return moved
+
+
+def move_failed_scrapes():
+    """
+    move the placeholder documents of links that failed to scrape from db.streaming to
+    the db.failed_scrapes negative cache.  run after split_article_bodies, which marks
+    them with has_text False
+    """
+
+    try:
+        client = pymongo.MongoClient('localhost', 27017)
+    except Exception as e:
+        print('Failed to connect to mongo')
+
+    db = client.noozli
+    collection = db.streaming
+    failed_scrapes = db.failed_scrapes
+
+    # same expiry rss.parse_feed uses, 30 days
+    failed_scrapes.ensure_index('failed_at', expireAfterSeconds=2592000)
+
+    moved = 0
+    for post in collection.find({'has_text': False}, {'links': True, 'source': True, 'timestamp': True}):
+        for link in post['links']:
+            # the original failure time is unknown, the feed timestamp lets the entries expire on schedule
+            failed_scrapes.update({'_id': link}, {'$set': {'source': post.get('source'), 'reason': 'unknown', 'failed_at': post['timestamp']}}, upsert=True)
+
+        collection.remove({'_id': post['_id']})
+        moved += 1
+
+    return moved
@@ -0,0 +1,249 @@
+import sys
+sys.path.append('../src')
+sys.path.append('../src/algos')
+
+import cassandra_tools
+import collections
+import database
+import dna_vectors
+import functools
+import json
+import multiprocessing
+import numpy as np
+import os
+import pymongo
+import replay
+
+from cassandra.cluster import Cluster
+from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.query import SimpleStatement
+
+session = None
+collection = None
+
+
+def connect(nodes=['127.0.0.1']):
+    """
+    open the cassandra session and mongo client of a worker process, neither can be shared
+    across a fork
+    """
+
+    global session, collection
+    session = Cluster(nodes).connect()
+    collection = pymongo.MongoClient('localhost', 27017).noozli.streaming
+
+
+def stream_histories(token_range, fetch_size=5000):
+    """
+    read noozli.user_articles_ordered for the users in a token range
+
+    a token range scan returns the rows of a user together, newest first
+
+    :param token_range: (start, end) from cassandra_tools.token_ranges
+    :returns: generator of (user_id, list of (article_id, analytics string)) oldest first,
+              article_id is None for rows written before the article_id column
+    """
+
+    query = SimpleStatement("SELECT user_id, article_id, analytics FROM noozli.user_articles_ordered WHERE token(user_id) > %s AND token(user_id) <= %s;", fetch_size=fetch_size)
+
+    user_id = None
+    history = []
+    for row in session.execute(query, token_range):
+        if row.user_id != user_id:
+            if user_id is not None:
+                yield user_id, history[::-1]
+            user_id = row.user_id
+            history = []
+        history.append((row.article_id, row.analytics))
+
+    if user_id is not None:
+        yield user_id, history[::-1]
+
+
+def resolve_article_ids(histories):
+    """
+    find the article of history rows written before the article_id column by matching
+    their analytics text with noozli.user_articles, rows that match no article or more
+    than one are left without
+
+    :param histories: list of (user_id, history) from stream_histories, updated in place
+    """
+
+    unresolved = [ i for i, (user_id, history) in enumerate(histories) if any(article_id is None for article_id, analytics in history) ]
+    if len(unresolved) == 0:
+        return
+
+    query_cql = session.prepare("SELECT article_id, analytics FROM noozli.user_articles WHERE user_id = ?;")
+    results = execute_concurrent_with_args(session, query_cql, [ (histories[i][0],) for i in unresolved ], concurrency=100)
+
+    for i, (success, rows) in zip(unresolved, results):
+        if not success:
+            continue
+
+        articles = collections.defaultdict(list)
+        for row in rows:
+            articles[row.analytics].append(row.article_id)
+
+        user_id, history = histories[i]
+        for j, (article_id, analytics) in enumerate(history):
+            if article_id is None and len(articles[analytics]) == 1:
+                history[j] = (articles[analytics][0], analytics)
+
+
+def load_article_dna(article_ids, chunk_size=1000):
+    """
+    :param article_ids: list of strings
+    :returns: (dict article_id -> row, (articles, dna_length) array), articles not in
+              db.streaming are left out
+    """
+
+    rows = {}
+    article_dna = []
+    for i in range(0, len(article_ids), chunk_size):
+        for article in collection.find({'article_id': {'$in': article_ids[i:i+chunk_size]}}, {'article_id': True, 'dna': True, 'topics': True}):
+            if article['article_id'] not in rows:
+                rows[article['article_id']] = len(article_dna)
+                article_dna.append(dna_vectors.article_dna(article))
+
+    return rows, np.array(article_dna, dtype=float).reshape(len(article_dna), dna_vectors.dna_length)
+
+
+def replay_batch(histories, dry_run, diff_file, counts):
+    """
+    replay the dna of a batch of users and write it back, or write the differences to
+    diff_file in a dry run
+
+    the dna is written with the write time of the stored dna plus one microsecond instead
+    of the current time, a user that learned while the batch was replayed keeps the dna
+    learned live
+
+    :param histories: list of (user_id, history) from stream_histories
+    :param dry_run: bool
+    :param diff_file: file, json line per user with the stored and the replayed dna
+    :param counts: collections.Counter, updated with the outcome of each user
+    """
+
+    resolve_article_ids(histories)
+
+    article_ids = list({ article_id for user_id, history in histories for article_id, analytics in history if article_id is not None })
+    article_rows, article_dna = load_article_dna(article_ids)
+
+    query_cql = session.prepare("SELECT id, dna, dna_blob, dna_version, engagement_mapping, dna_update_algo, WRITETIME(dna), WRITETIME(dna_blob) FROM noozli.users WHERE id = ?;")
+    results = execute_concurrent_with_args(session, query_cql, [ (user_id,) for user_id, history in histories ], concurrency=100)
+
+    # users with the same algorithms are replayed together
+    groups = collections.defaultdict(list)
+    for (user_id, history), (success, rows) in zip(histories, results):
+        if not success or len(rows) == 0:
+            counts['no user row'] += 1
+            continue
+
+        user_data = rows[0]
+        events = []
+        for article_id, analytics in history:
+            if article_id is None:
+                counts['unresolved events'] += 1
+            elif article_id not in article_rows:
+                counts['missing articles'] += 1
+            else:
+                events.append((article_rows[article_id], json.loads(analytics)))
+
+        # replaying nothing would reset the dna to a new user's
+        if len(events) == 0:
+            counts['no events'] += 1
+            continue
+
+        groups[(user_data.engagement_mapping, user_data.dna_update_algo)].append((user_data, events))
+
+    update_cql = session.prepare("UPDATE noozli.users USING TIMESTAMP ? SET dna_blob = ?, dna_version = ?, dna = null WHERE id = ?;")
+
+    for (mapping_algo, update_algo), users in groups.items():
+        try:
+            coeffs = replay.engagement_coeffs([ analytics for user_data, events in users for row, analytics in events ], mapping_algo)
+            bounds = np.cumsum([ len(events) for user_data, events in users ])[:-1]
+            events = [ (np.array([ row for row, analytics in user_events ], dtype=np.int64), user_coeffs)
+                       for (user_data, user_events), user_coeffs in zip(users, np.split(coeffs, bounds)) ]
+            dna = replay.replay_dna(events, article_dna, update_algo)
+        except ValueError as e:
+            print('Not replaying ' + str(len(users)) + ' users: ' + str(e))
+            counts['unsupported algorithm'] += len(users)
+            continue
+
+        counts['users'] += len(users)
+
+        if dry_run:
+            for (user_data, user_events), user_dna in zip(users, dna):
+                stored = database.user_dna(user_data)
+                diff_file.write(json.dumps({'user_id': str(user_data.id), 'events': len(user_events), 'change': float(np.max(np.abs(user_dna - stored))),
+                                            'stored': stored, 'replayed': user_dna.tolist()}) + '\n')
+            continue
+
+        params = []
+        for (user_data, user_events), user_dna in zip(users, dna):
+            dna_blob, dna_version = dna_vectors.pack_user_dna(user_dna.tolist())
+            # write times of the dna text and the blob, the one holding the dna is set
+            dna_written = max([ written for written in user_data[6:8] if written is not None ] + [0])
+            params.append((dna_written + 1, dna_blob, dna_version, user_data.id))
+
+        for success, rows in execute_concurrent_with_args(session, update_cql, params, concurrency=100, raise_on_first_error=False):
+            if success:
+                counts['written'] += 1
+            else:
+                counts['failed writes'] += 1
+
+
+def replay_range(token_range, dry_run=True, diff_dir='.', batch_size=1000):
+    """
+    replay the dna of the users in a token range, batch_size users at a time
+
+    :param token_range: (start, end) from cassandra_tools.token_ranges
+    :returns: collections.Counter of the outcome of each user
+    """
+
+    counts = collections.Counter()
+    diff_file = open(os.path.join(diff_dir, 'replay.' + str(token_range[0]) + '.jsonl'), 'w') if dry_run else None
+
+    batch = []
+    for user_history in stream_histories(token_range):
+        batch.append(user_history)
+        if len(batch) == batch_size:
+            replay_batch(batch, dry_run, diff_file, counts)
+            batch = []
+
+    if len(batch) > 0:
+        replay_batch(batch, dry_run, diff_file, counts)
+
+    if diff_file is not None:
+        diff_file.close()
+
+    return counts
+
+
+def replay_all(processes=4, parts=64, dry_run=True, diff_dir='.'):
+    """
+    recompute the dna of every user with engagements from noozli.user_articles_ordered
+    under the current engagement_mapping and update_dna, see replay.py.  run after either
+    changes to retrain existing users.
+
+    users are replayed by token range in parallel.  a dry run writes one replay.<token>.jsonl
+    per range to diff_dir with the stored and the replayed dna of each user instead of
+    writing the dna back.
+
+    :param processes: int, worker processes
+    :param parts: int, token ranges, more ranges than processes keeps the workers busy until the end
+    :param dry_run: bool
+    :param diff_dir: string, directory for the dry run diffs
+    :returns: collections.Counter of the outcome of each user
+    """
+
+    pool = multiprocessing.Pool(processes, initializer=connect)
+
+    totals = collections.Counter()
+    for counts in pool.imap_unordered(functools.partial(replay_range, dry_run=dry_run, diff_dir=diff_dir), cassandra_tools.token_ranges(parts)):
+        totals.update(counts)
+        print(dict(totals))
+
+    pool.close()
+    pool.join()
+
+    return totals